@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from config import LOG_DROP_WHEN_FULL, LOG_PUT_TIMEOUT
+from database import SessionLocal
+from models import EventLogger, AppEventsLogger
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+WRITE_ATTEMPTS = 2
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 write_attempts=WRITE_ATTEMPTS, put_timeout=LOG_PUT_TIMEOUT, drop_when_full=LOG_DROP_WHEN_FULL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_attempts = write_attempts
+        self.put_timeout = put_timeout
+        self.drop_when_full = drop_when_full
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._stopping = threading.Event()
+        self.written = 0
+        self.failed = 0
+        self.blocked = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.last_error = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def log(self, model, **fields):
+        if not self.running:
+            self._write([(model, fields)])
+            return
+        try:
+            self._queue.put_nowait((model, fields))
+            return
+        except queue.Full:
+            pass
+        if self.drop_when_full:
+            self.dropped += 1
+            return
+        # Backpressure: the caller waits a bounded time for room; after that the record goes to the
+        # logging fallback rather than being lost or written inline
+        self.blocked += 1
+        try:
+            self._queue.put((model, fields), timeout=self.put_timeout)
+        except queue.Full:
+            self.spilled += 1
+            logger.warning("Log queue full, %s record not stored: %s", model.__tablename__, fields)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        rows = {}
+        for model, fields in batch:
+            rows.setdefault(model, []).append(fields)
+        for attempt in range(1, self.write_attempts + 1):
+            db = SessionLocal()
+            try:
+                for model, model_rows in rows.items():
+                    db.execute(insert(model), model_rows)
+                db.commit()
+                self.written += len(batch)
+                return
+            except Exception as error:
+                db.rollback()
+                self.last_error = str(error)
+            finally:
+                db.close()
+        # The log tables are unreachable; the records are kept in the application log instead
+        self.failed += len(batch)
+        logger.error("%d log record(s) not stored after %d attempt(s): %s",
+                     len(batch), self.write_attempts, self.last_error)
+        for model, fields in batch:
+            logger.error("Unstored %s record: %s", model.__tablename__, fields)
+
+
+log_writer = LogWriter()
+
+
+def log_event(event_type: int, user_id: int, event_body: str, client_host: str = None, event_date=None):
+    log_writer.log(EventLogger,
+                   event_type=event_type,
+                   user_id=user_id,
+                   event_body=event_body,
+                   client_host=client_host,
+                   event_date=event_date or datetime.now())
+
+
+def log_app_event(service: str, event: str):
+    log_writer.log(AppEventsLogger,
+                   service_name=service,
+                   event_body=event,
+                   event_date=datetime.now())
@@ -0,0 +1,145 @@
+import asyncio
+import inspect
+import time
+
+from app_tasks import scheduled_services
+from app_tasks.startup import main_app_log, process_services
+from config import SERVICE_RELOAD_INTERVAL
+
+
+class ServiceStats:
+    __slots__ = ('interval', 'runs', 'failures', 'skipped', 'running', 'last_duration', 'max_duration',
+                 'total_duration', 'last_lag', 'max_lag', 'last_run', 'last_error')
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.running = False
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_run = None
+        self.last_error = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ServiceRunner:
+    def __init__(self, module=scheduled_services, reload_interval=SERVICE_RELOAD_INTERVAL):
+        self.module = module
+        self.reload_interval = reload_interval
+        self.stats = {}
+        self._tasks = {}
+        self._invalid = {}
+        self._supervisor = None
+
+    def start(self):
+        if self._supervisor is None:
+            self._supervisor = asyncio.create_task(self._supervise())
+
+    async def stop(self):
+        tasks = [task for task in (self._supervisor, *self._tasks.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._supervisor = None
+        self._tasks.clear()
+
+    async def _supervise(self):
+        while True:
+            try:
+                self.apply(await asyncio.to_thread(process_services) or {})
+            except Exception as error:
+                main_app_log("Scheduler", f"Settings reload failed: {error}")
+            await asyncio.sleep(self.reload_interval)
+
+    def apply(self, service_dict):
+        # Interval and is_active changes in app_services_settings take effect without a restart
+        service_dict = self._valid(service_dict)
+        for service_name in list(self._tasks):
+            if service_name not in service_dict:
+                self._tasks.pop(service_name).cancel()
+                main_app_log("Scheduler", f"Service stopped: {service_name}")
+        for service_name, service_interval in service_dict.items():
+            if not hasattr(self.module, service_name):
+                continue
+            stats = self.stats.get(service_name)
+            if stats is None:
+                stats = self.stats[service_name] = ServiceStats(service_interval)
+            stats.interval = service_interval
+            task = self._tasks.get(service_name)
+            if task is not None and task.done():
+                # The loop itself died; run_once keeps service errors inside, so this is unexpected
+                error = None if task.cancelled() else task.exception()
+                stats.last_error = str(error) if error else 'cancelled'
+                main_app_log("Scheduler", f"Service loop ended: {service_name} ({stats.last_error}), restarting")
+                task = None
+            if task is None:
+                self._tasks[service_name] = asyncio.create_task(self._service_loop(service_name, stats))
+                main_app_log("Scheduler", f"Service started: {service_name}, interval: {service_interval}s")
+
+    def _valid(self, service_dict):
+        # A NULL or non-positive interval would stop the loop on its first sleep; such rows are skipped
+        valid = {}
+        for service_name, service_interval in service_dict.items():
+            try:
+                interval = float(service_interval)
+            except (TypeError, ValueError):
+                interval = 0.0
+            if interval > 0:
+                valid[service_name] = service_interval
+                self._invalid.pop(service_name, None)
+            elif self._invalid.get(service_name, object()) != service_interval:
+                self._invalid[service_name] = service_interval
+                main_app_log("Scheduler", f"Service skipped: {service_name}, invalid interval: {service_interval}")
+        return valid
+
+    async def _service_loop(self, service_name, stats):
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + stats.interval
+        while True:
+            await asyncio.sleep(max(next_run - loop.time(), 0))
+            lag = loop.time() - next_run
+            await self.run_once(service_name, stats, lag)
+            next_run += stats.interval
+            now = loop.time()
+            if next_run < now:
+                # A run outlasted its interval: drop the missed slots instead of queueing copies
+                missed = int((now - next_run) // stats.interval) + 1
+                stats.skipped += missed
+                next_run += missed * stats.interval
+
+    async def run_once(self, service_name, stats, lag=0.0):
+        service_func = getattr(self.module, service_name)
+        stats.running = True
+        stats.last_lag = lag
+        stats.max_lag = max(stats.max_lag, lag)
+        started = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(service_func):
+                await service_func()
+            else:
+                await asyncio.to_thread(service_func)
+        except Exception as error:
+            stats.failures += 1
+            stats.last_error = str(error)
+            main_app_log(service_name, f"FAILED: {error}")
+        finally:
+            duration = time.perf_counter() - started
+            stats.running = False
+            stats.runs += 1
+            stats.last_duration = duration
+            stats.max_duration = max(stats.max_duration, duration)
+            stats.total_duration += duration
+            stats.last_run = time.time()
+
+    def metrics(self):
+        return {service_name: stats.as_dict() for service_name, stats in self.stats.items()}
+
+
+service_runner = ServiceRunner()
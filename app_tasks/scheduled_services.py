@@ -1,3 +1,16 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from app_tasks.startup import main_app_log
+from config import SWEEP_BATCH_SIZE, SWEEP_MAX_BATCHES, MAP_USER_IDLE_HOURS
+from database import SessionLocal
+from game_engine.tick_engine import drop_tick_engine, process_ticks
+from game_engine.trajectory import archive_game, games_to_archive
+from game_engine.zone_index import drop_zone_index
+from models import EmailConfirm, MapUsers
+
+
 def service1():
     # TASK 1
     print("Scheduled task 1 Complete !")
@@ -12,3 +25,41 @@ def cos_tam():
     # TASK 3
     print("Scheduled task 3 Complete !")
 
+
+def game_tick():
+    # Flush buffered position reports of every running game
+    process_ticks()
+
+
+def delete_in_batches(db, model, condition, batch_size=SWEEP_BATCH_SIZE, max_batches=SWEEP_MAX_BATCHES):
+    # Short transactions keep row locks brief; leftovers are picked up by the next run
+    deleted = 0
+    for _ in range(max_batches):
+        ids = select(model.id).where(condition).limit(batch_size).scalar_subquery()
+        count = db.execute(delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False)).rowcount
+        db.commit()
+        deleted += count
+        if count < batch_size:
+            break
+    return deleted
+
+
+def expiry_sweeper():
+    # Remove expired e-mail confirmations and map positions of players idle for too long
+    now = datetime.now()
+    with SessionLocal() as db:
+        confirmations = delete_in_batches(db, EmailConfirm, EmailConfirm.expire_date < now)
+        map_users = delete_in_batches(db, MapUsers, MapUsers.last_update < now - timedelta(hours=MAP_USER_IDLE_HOURS))
+    if confirmations or map_users:
+        main_app_log("expiry_sweeper", f"Deleted email confirmations: {confirmations}, map users: {map_users}")
+
+
+def trajectory_archiver():
+    # Compress the location history of finished games into player_trajectories
+    with SessionLocal() as db:
+        for game_id in games_to_archive(db):
+            drop_tick_engine(game_id)
+            drop_zone_index(game_id)
+            result = archive_game(db, game_id)
+            main_app_log("trajectory_archiver", f"Game {game_id}: {result['raw_points']} points "
+                                                f"-> {result['points']} for {result['players']} players")
@@ -0,0 +1,219 @@
+"""Offline benchmarks of the auth and game hot paths.
+
+Runs against a throwaway SQLite database with the models.Base schema; mail is only queued in the
+outbox (no SMTP worker) and the public IP lookup is disabled, so nothing leaves the machine.
+The TestClient needs httpx, which is not a runtime dependency:
+
+    pip install -r requirements-bench.txt
+    python benchmarks/run.py --output benchmarks/baseline.json
+    python benchmarks/run.py --baseline benchmarks/baseline.json --fail-on-regression
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def configure(args):
+    # Has to run before any project module is imported: config is read at import time
+    database_file = os.path.join(tempfile.mkdtemp(prefix='asgr-bench-'), 'bench.db')
+    os.environ.update({'DATABASE_URL': f"sqlite:///{database_file}",
+                       'ASYNC_DATABASE_URL': f"sqlite+aiosqlite:///{database_file}",
+                       'PUBLIC_IP_LOOKUP': '0',
+                       'BCRYPT_ROUNDS': str(args.bcrypt_rounds),
+                       'RATE_LIMIT_BACKEND': 'memory',
+                       'REGISTRATIONS_PER_IP': str(10 ** 9),
+                       'LOGIN_FAILURES_PER_USER': str(10 ** 9),
+                       'LOGIN_FAILURES_PER_IP': str(10 ** 9)})
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+
+def summarize(name, samples, elapsed, operations=None):
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {'name': name,
+            'count': len(samples),
+            'operations': operations or len(samples),
+            'throughput': round((operations or len(samples)) / elapsed, 2) if elapsed else None,
+            'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+            'p50_ms': round(percentile(0.50), 3),
+            'p95_ms': round(percentile(0.95), 3),
+            'p99_ms': round(percentile(0.99), 3)}
+
+
+def measure(name, calls, operations_per_call=1):
+    samples = []
+    started = time.perf_counter()
+    for call in calls:
+        begin = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+    return summarize(name, samples, elapsed, len(samples) * operations_per_call)
+
+
+def expect(response, code):
+    if response.status_code != code:
+        raise RuntimeError(f"{response.request.method} {response.request.url} -> "
+                           f"{response.status_code}: {response.text[:200]}")
+    return response
+
+
+def seed_game(db, zones, players):
+    from models import Games, GameStatus, MapLayer2, ShapeTypes, Teams, TeamSlots
+
+    db.add_all([ShapeTypes(id=1, type='Polygon'), ShapeTypes(id=2, type='Circle'),
+                GameStatus(id=1, status_name='running')])
+    game = Games(game_name='benchmark', players=players, teams=1, game_status_id=1, created=datetime.now())
+    db.add(game)
+    db.flush()
+    rng = random.Random(zones)
+    db.add_all([MapLayer2(game_id=game.id, zone_id=zone, zone_name=f"zone {zone}", shape_type=2,
+                          zone_shape=f"[{50 + rng.uniform(-0.05, 0.05):.6f}, {20 + rng.uniform(-0.05, 0.05):.6f}], "
+                                     f"{{radius: {rng.randint(50, 500)}}}")
+                for zone in range(zones)])
+    team = Teams(game_id=game.id, team_name='benchmark', team_slots=players)
+    db.add(team)
+    db.flush()
+    db.add_all([TeamSlots(team_id=team.id, game_id=game.id, user_id=user_id) for user_id in range(1, players + 1)])
+    db.commit()
+    return game.id
+
+
+def run(args):
+    from fastapi.testclient import TestClient
+
+    import main
+    import models
+    from app_tasks.log_writer import log_writer
+    from database import SessionLocal, get_engine
+    from game_engine.tick_engine import get_tick_engine, drop_tick_engine
+    from token_cache import token_cache
+
+    models.Base.metadata.create_all(bind=get_engine())
+    # No context manager: startup would also start the SMTP outbox worker, only the log writer is wanted
+    client = TestClient(main.create_app())
+    log_writer.start()
+    results = []
+    try:
+        accounts = [(f"bench{number}@example.com", f"password{number}") for number in range(args.users)]
+        results.append(measure('register', (
+            lambda email=email, password=password: expect(
+                client.post('/account/register', json={'email': email, 'password': password}), 201)
+            for email, password in accounts)))
+
+        tokens = []
+
+        def login(email, password):
+            response = expect(client.post('/account/login', data={'username': email, 'password': password}), 200)
+            tokens.append(response.json()['access_token'])
+
+        results.append(measure('login', (lambda email=email, password=password: login(email, password)
+                                         for email, password in accounts)))
+
+        with SessionLocal() as db:
+            game_id = seed_game(db, args.zones, args.players)
+
+        def report(token):
+            position = {'latitude': 50 + random.uniform(-0.05, 0.05), 'longitude': 20 + random.uniform(-0.05, 0.05)}
+            expect(client.post(f"/game/{game_id}/position", json=position,
+                               headers={'Authorization': f"Bearer {token}"}), 202)
+
+        token_cache.clear()
+        results.append(measure('authenticated_request', (lambda token=token: report(token)
+                                                         for token in tokens * args.requests_per_user)))
+        drop_tick_engine(game_id)
+
+        with SessionLocal() as db:
+            engine = get_tick_engine(db, game_id)
+            engine.checkpoint_interval = args.checkpoint_interval
+            rng = random.Random(args.players)
+            lats = [50 + rng.uniform(-0.05, 0.05) for _ in range(args.players)]
+            lons = [20 + rng.uniform(-0.05, 0.05) for _ in range(args.players)]
+
+            def tick():
+                for user_id in range(args.players):
+                    lats[user_id] += rng.uniform(-0.0002, 0.0002)
+                    lons[user_id] += rng.uniform(-0.0002, 0.0002)
+                    engine.report(user_id + 1, lats[user_id], lons[user_id])
+                engine.flush(db)
+
+            result = measure('tick_ingest', (tick for _ in range(args.ticks)), operations_per_call=args.players)
+            result.update({'players': args.players, 'zones': args.zones})
+            results.append(result)
+    finally:
+        log_writer.stop()
+    return results
+
+
+def compare(results, baseline, threshold):
+    previous = {result['name']: result for result in baseline.get('results', [])}
+    regressions = []
+    print(f"\n{'benchmark':<24}{'p95 ms':>12}{'baseline':>12}{'change':>10}")
+    for result in results:
+        before = previous.get(result['name'])
+        if before is None:
+            print(f"{result['name']:<24}{result['p95_ms']:>12.3f}{'-':>12}{'-':>10}")
+            continue
+        change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0.0
+        print(f"{result['name']:<24}{result['p95_ms']:>12.3f}{before['p95_ms']:>12.3f}{change:>+10.1%}")
+        if change > threshold:
+            regressions.append(result['name'])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help='accounts to register and log in')
+    parser.add_argument('--requests-per-user', type=int, default=10, help='authenticated requests per account')
+    parser.add_argument('--players', type=int, default=500, help='players per simulated tick')
+    parser.add_argument('--zones', type=int, default=200, help='zones in the simulated game')
+    parser.add_argument('--ticks', type=int, default=50, help='simulated ticks')
+    parser.add_argument('--checkpoint-interval', type=float, default=5.0, help='map_users checkpoint interval (s)')
+    parser.add_argument('--bcrypt-rounds', type=int, default=int(os.getenv('BCRYPT_ROUNDS', '12')))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='p95 slowdown counted as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    configure(args)
+    results = run(args)
+    report = {'created': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'arguments': {key: value for key, value in vars(args).items()
+                            if key not in ('output', 'baseline', 'fail_on_regression')},
+              'results': results}
+
+    print(f"{'benchmark':<24}{'ops/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for result in results:
+        print(f"{result['name']:<24}{result['throughput']:>12.1f}{result['p50_ms']:>10.3f}"
+              f"{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions and args.fail_on_regression:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import ipaddress
+import threading
+import time
+
+import requests
+from starlette.requests import Request
+
+from instrumentation import external_call
+from config import TRUSTED_PROXIES, FORWARDED_HEADER, PUBLIC_IP_LOOKUP, PUBLIC_IP_URL, PUBLIC_IP_TTL
+
+trusted_networks = [ipaddress.ip_network(proxy, strict=False) for proxy in TRUSTED_PROXIES]
+
+_public_ip = {'ip': None, 'expires': 0.0, 'refreshing': False}
+_public_ip_lock = threading.Lock()
+
+
+def _address(value):
+    try:
+        return ipaddress.ip_address(value.strip().strip('[]'))
+    except (ValueError, AttributeError):
+        return None
+
+
+def is_trusted(address):
+    return address is not None and any(address in network for network in trusted_networks)
+
+
+def get_client_ip(request: Request):
+    peer = request.client.host if request.client else None
+    address = _address(peer)
+    if not is_trusted(address):
+        return _with_public_fallback(peer, address)
+    # Walk the forwarded chain from the nearest hop and stop at the first address we do not trust. When every
+    # hop is trusted (clients inside the proxy's network) the leftmost one is the client.
+    client, client_address = peer, address
+    hops = [hop.strip() for hop in request.headers.get(FORWARDED_HEADER, '').split(',') if hop.strip()]
+    for hop in reversed(hops):
+        hop_address = _address(hop)
+        if hop_address is None:
+            break
+        client, client_address = hop, hop_address
+        if not is_trusted(hop_address):
+            break
+    return _with_public_fallback(client, client_address)
+
+
+def _with_public_fallback(ip, address):
+    # Local development: client and server share a machine, so the server's public IP is the client's
+    if PUBLIC_IP_LOOKUP and address is not None and (address.is_private or address.is_loopback):
+        return cached_public_ip() or ip
+    return ip
+
+
+def cached_public_ip():
+    # Never blocks: a stale value triggers a refresh on a background thread
+    with _public_ip_lock:
+        if time.monotonic() >= _public_ip['expires'] and not _public_ip['refreshing']:
+            _public_ip['refreshing'] = True
+            threading.Thread(target=_refresh_public_ip, name='public-ip', daemon=True).start()
+        return _public_ip['ip']
+
+
+def _refresh_public_ip():
+    ip = None
+    try:
+        with external_call('public_ip'):
+            ip = requests.get(PUBLIC_IP_URL, timeout=5).json()["ip"]
+    except (requests.RequestException, ValueError, KeyError):
+        pass
+    with _public_ip_lock:
+        if ip is not None:
+            _public_ip['ip'] = ip
+        _public_ip['expires'] = time.monotonic() + (PUBLIC_IP_TTL if ip is not None else 60)
+        _public_ip['refreshing'] = False
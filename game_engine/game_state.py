@@ -0,0 +1,168 @@
+import numpy as np
+from sqlalchemy import Integer, select, type_coerce
+
+from database import upsert
+from game_engine.zone_index import LAYER_FIELDS, distances
+from models import COORDINATE_SCALE, MapUsers, Teams, TeamSlots
+
+INITIAL_CAPACITY = 16
+NO_ZONE = 0
+
+
+class PlayerRecord:
+    # Per-player metadata only; positions and zones live in the GameState arrays
+    __slots__ = ('user_id', 'row', 'slot_id', 'team_id', 'role', 'slot_type', 'last_update')
+
+    def __init__(self, user_id, row, slot_id=None, team_id=None, role=None, slot_type=None, last_update=None):
+        self.user_id = user_id
+        self.row = row
+        self.slot_id = slot_id
+        self.team_id = team_id
+        self.role = role
+        self.slot_type = slot_type
+        self.last_update = last_update
+
+
+class GameState:
+    def __init__(self, game_id, capacity=INITIAL_CAPACITY):
+        self.game_id = game_id
+        self.size = 0
+        self.players = {}
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.lats = np.full(capacity, np.nan, dtype=np.float64)
+        self.lons = np.full(capacity, np.nan, dtype=np.float64)
+        self.stored_lats = np.full(capacity, np.nan, dtype=np.float64)
+        self.stored_lons = np.full(capacity, np.nan, dtype=np.float64)
+        self.zones = np.zeros((capacity, len(LAYER_FIELDS)), dtype=np.int32)
+        self.dirty = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, needed):
+        capacity = len(self.user_ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        extra = capacity - len(self.user_ids)
+        self.user_ids = np.concatenate([self.user_ids, np.zeros(extra, dtype=np.int64)])
+        self.lats = np.concatenate([self.lats, np.full(extra, np.nan)])
+        self.lons = np.concatenate([self.lons, np.full(extra, np.nan)])
+        self.stored_lats = np.concatenate([self.stored_lats, np.full(extra, np.nan)])
+        self.stored_lons = np.concatenate([self.stored_lons, np.full(extra, np.nan)])
+        self.zones = np.concatenate([self.zones, np.zeros((extra, len(LAYER_FIELDS)), dtype=np.int32)])
+        self.dirty = np.concatenate([self.dirty, np.zeros(extra, dtype=bool)])
+
+    def player(self, user_id):
+        record = self.players.get(user_id)
+        if record is None:
+            self._grow(self.size + 1)
+            record = PlayerRecord(user_id, self.size)
+            self.user_ids[self.size] = user_id
+            self.players[user_id] = record
+            self.size += 1
+        return record
+
+    def hydrate(self, db):
+        # Plain column tuples instead of ORM instances; nothing ends up in the session identity map
+        positions = db.execute(select(MapUsers.user_id,
+                                      type_coerce(MapUsers.latitude, Integer),
+                                      type_coerce(MapUsers.longitude, Integer),
+                                      MapUsers.last_update,
+                                      *(getattr(MapUsers, field) for field in LAYER_FIELDS))
+                               .where(MapUsers.game_id == self.game_id)).all()
+        for user_id, latitude, longitude, last_update, *zones in positions:
+            record = self.player(user_id)
+            record.last_update = last_update
+            if latitude is not None and longitude is not None:
+                self.lats[record.row] = latitude / COORDINATE_SCALE
+                self.lons[record.row] = longitude / COORDINATE_SCALE
+                self.stored_lats[record.row] = self.lats[record.row]
+                self.stored_lons[record.row] = self.lons[record.row]
+            self.zones[record.row] = [zone or NO_ZONE for zone in zones]
+        slots = db.execute(select(TeamSlots.user_id, TeamSlots.id, TeamSlots.team_id,
+                                  TeamSlots.role, TeamSlots.slot_type)
+                           .join(Teams, Teams.id == TeamSlots.team_id)
+                           .where(Teams.game_id == self.game_id, TeamSlots.user_id.is_not(None))).all()
+        for user_id, slot_id, team_id, role, slot_type in slots:
+            self.assign_slot(user_id, slot_id, team_id, role, slot_type)
+        return self
+
+    def assign_slot(self, user_id, slot_id, team_id, role=None, slot_type=None):
+        record = self.player(user_id)
+        record.slot_id = slot_id
+        record.team_id = team_id
+        record.role = role
+        record.slot_type = slot_type
+        return record
+
+    def release_slot(self, user_id):
+        record = self.players.get(user_id)
+        if record is not None:
+            record.slot_id = record.team_id = record.role = record.slot_type = None
+
+    def holds_slot(self, user_id):
+        record = self.players.get(user_id)
+        return record is not None and record.slot_id is not None
+
+    def rows(self, user_ids):
+        return np.fromiter((self.player(user_id).row for user_id in user_ids), dtype=np.int64, count=len(user_ids))
+
+    def apply(self, user_ids, lats, lons, zones, timestamps):
+        # Returns the touched rows with their previous positions and zones for delta building
+        rows = self.rows(user_ids)
+        previous = (self.lats[rows], self.lons[rows], self.zones[rows])
+        self.lats[rows] = lats
+        self.lons[rows] = lons
+        self.zones[rows] = zones
+        self.dirty[rows] = True
+        for user_id, timestamp in zip(user_ids, timestamps):
+            self.players[user_id].last_update = timestamp
+        return rows, previous
+
+    def moved(self, rows, lats, lons, min_distance):
+        # Mask of reports far enough from the last stored point of their player to be worth logging
+        moved = np.isnan(self.stored_lats[rows])
+        known = ~moved
+        moved[known] = distances(self.stored_lats[rows][known], self.stored_lons[rows][known],
+                                 lats[known], lons[known]) >= min_distance
+        return moved
+
+    def mark_stored(self, rows, lats, lons):
+        # Only called once the events are committed, so a failed tick is not taken for a stored point
+        self.stored_lats[rows] = lats
+        self.stored_lons[rows] = lons
+
+    def checkpoint(self, db):
+        rows = np.flatnonzero(self.dirty[:self.size])
+        if not len(rows):
+            return rows
+        positions = []
+        for row in rows.tolist():
+            user_id = int(self.user_ids[row])
+            position = {'user_id': user_id,
+                        'game_id': self.game_id,
+                        'latitude': float(self.lats[row]),
+                        'longitude': float(self.lons[row]),
+                        'last_update': self.players[user_id].last_update}
+            for layer, field in enumerate(LAYER_FIELDS):
+                position[field] = int(self.zones[row, layer]) or None
+            positions.append(position)
+        upsert(db, MapUsers, positions,
+               index_elements=['game_id', 'user_id'],
+               update_columns=['latitude', 'longitude', 'last_update', *LAYER_FIELDS])
+        # The caller clears the dirty flags (see clean) after the commit went through
+        return rows
+
+    def clean(self, rows):
+        self.dirty[rows] = False
+
+    def snapshot_rows(self):
+        located = np.flatnonzero(~np.isnan(self.lats[:self.size]))
+        return [[int(self.user_ids[row]), float(self.lats[row]), float(self.lons[row]),
+                 [int(zone) or None for zone in self.zones[row]]] for row in located.tolist()]
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.user_ids, self.lats, self.lons, self.stored_lats, self.stored_lons,
+                                              self.zones, self.dirty))
@@ -0,0 +1,51 @@
+import asyncio
+import json
+import threading
+
+CLIENT_QUEUE_SIZE = 64
+
+
+class LiveHub:
+    def __init__(self, queue_size=CLIENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def subscribe(self, game_id):
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(game_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, game_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(game_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[game_id]
+
+    def subscribers(self, game_id):
+        return len(self._subscribers.get(game_id, ()))
+
+    def publish(self, game_id, message):
+        # Called from the tick thread; the message is serialized once for every client
+        with self._lock:
+            queues = list(self._subscribers.get(game_id, ()))
+        if not queues or self._loop is None or self._loop.is_closed():
+            return
+        payload = json.dumps(message, default=str)
+        self._loop.call_soon_threadsafe(_deliver, queues, payload)
+
+
+def _deliver(queues, payload):
+    for queue in queues:
+        if queue.full():
+            # A slow client loses its oldest delta rather than holding everyone back
+            queue.get_nowait()
+        queue.put_nowait(payload)
+
+
+live_hub = LiveHub()
@@ -0,0 +1,100 @@
+import io
+from itertools import groupby
+
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import DBAPIError
+
+from database import dialect_insert
+from models import GameTicks, InGameLocationEvents
+
+LOCATION_COLUMNS = ('user_id', 'game_id', 'latitude', 'longitude', 'timestamp', 'tick_id')
+REPLAY_BATCH = 5000
+
+CHECK_VIOLATION = '23514'
+
+
+def partition_name(game_id):
+    return f"ingame_location_events_g{int(game_id)}"
+
+
+def ensure_partition(db, game_id):
+    # Called for a validated game inside the caller's transaction; committing is left to the caller
+    game_id = int(game_id)
+    if db.bind.dialect.name != 'postgresql':
+        return
+    try:
+        with db.begin_nested():
+            db.execute(text(f"CREATE TABLE IF NOT EXISTS {partition_name(game_id)} "
+                            f"PARTITION OF ingame_location_events FOR VALUES IN ({game_id})"))
+    except DBAPIError as error:
+        if getattr(error.orig, 'pgcode', None) != CHECK_VIOLATION:
+            raise
+        # Rows of this game already landed in the default partition; keep writing there
+
+
+def drop_partition(db, game_id):
+    if db.bind.dialect.name == 'postgresql':
+        db.execute(text(f"DROP TABLE IF EXISTS {partition_name(game_id)}"))
+    # Without a partition of its own (or on other dialects) the game's rows sit in the shared table
+    db.query(InGameLocationEvents).filter(InGameLocationEvents.game_id == game_id).delete()
+
+
+def next_tick(db, game_id, last_tick=0):
+    # Atomic increment of the game's counter row, so tick ids stay unique across workers and restarts;
+    # last_tick seeds the row for games whose events predate the counter
+    statement = dialect_insert(db, GameTicks).values(game_id=game_id, tick_id=last_tick + 1)
+    statement = statement.on_conflict_do_update(index_elements=['game_id'],
+                                                set_={'tick_id': GameTicks.tick_id + 1})
+    return db.execute(statement.returning(GameTicks.tick_id)).scalar_one()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value)
+
+
+def append_location_events(db, rows):
+    if not rows:
+        return
+    if db.bind.dialect.name != 'postgresql':
+        db.execute(insert(InGameLocationEvents), rows)
+        return
+    # COPY is the cheapest append path on PostgreSQL and runs inside the session transaction
+    coordinate = InGameLocationEvents.latitude.type
+    buffer = io.StringIO()
+    for row in rows:
+        values = (row['user_id'], row['game_id'],
+                  coordinate.process_bind_param(row['latitude'], None),
+                  coordinate.process_bind_param(row['longitude'], None),
+                  row['timestamp'], row['tick_id'])
+        buffer.write('\t'.join(_copy_value(value) for value in values))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY ingame_location_events ({', '.join(LOCATION_COLUMNS)}) FROM STDIN", buffer)
+    finally:
+        cursor.close()
+
+
+def replay_ticks(db, game_id, from_tick=None, to_tick=None):
+    query = select(InGameLocationEvents.tick_id,
+                   InGameLocationEvents.user_id,
+                   InGameLocationEvents.latitude,
+                   InGameLocationEvents.longitude,
+                   InGameLocationEvents.timestamp) \
+        .where(InGameLocationEvents.game_id == game_id)
+    if from_tick is not None:
+        query = query.where(InGameLocationEvents.tick_id >= from_tick)
+    if to_tick is not None:
+        query = query.where(InGameLocationEvents.tick_id <= to_tick)
+    query = query.order_by(InGameLocationEvents.tick_id, InGameLocationEvents.user_id) \
+        .execution_options(yield_per=REPLAY_BATCH)
+    # yield_per streams through a server-side cursor instead of buffering the whole game
+    result = db.execute(query)
+    try:
+        for tick_id, rows in groupby(result, key=lambda row: row.tick_id):
+            yield tick_id, [(row.user_id, row.latitude, row.longitude, row.timestamp) for row in rows]
+    finally:
+        result.close()
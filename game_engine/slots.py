@@ -0,0 +1,80 @@
+from sqlalchemy import exists, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from models import Games, GameStatus, Teams, TeamSlots
+
+
+def _user_in_game(game_id, user_id):
+    taken = aliased(TeamSlots)
+    return exists().where(taken.user_id == user_id, taken.game_id == game_id)
+
+
+def _team_claimed(team_id):
+    claimed = aliased(TeamSlots)
+    return select(func.count()).select_from(claimed). \
+        where(claimed.team_id == team_id, claimed.user_id.is_not(None)).scalar_subquery()
+
+
+def _team_capacity(team_id):
+    return select(Teams.team_slots).where(Teams.id == team_id).scalar_subquery()
+
+
+def game_member(db, game_id, user_id):
+    # The game (owner and status name) and the slot the user holds in it; game is None when it does not exist
+    game = db.execute(select(Games.owner_id, GameStatus.status_name)
+                      .outerjoin(GameStatus, GameStatus.id == Games.game_status_id)
+                      .where(Games.id == game_id)).first()
+    if game is None:
+        return None, None
+    slot = db.execute(select(TeamSlots.id, TeamSlots.team_id, TeamSlots.role, TeamSlots.slot_type)
+                      .where(TeamSlots.user_id == user_id, TeamSlots.game_id == game_id)).first()
+    return game, slot
+
+
+def claim_slot(db, game_id, user_id, slot_id):
+    # The conditions live in the UPDATE itself, so two workers can never hand out the same slot; the unique
+    # (game_id, user_id) index turns away a second slot for the same player that raced past _user_in_game
+    statement = update(TeamSlots). \
+        where(TeamSlots.id == slot_id,
+              TeamSlots.user_id.is_(None),
+              TeamSlots.game_id == game_id,
+              ~_user_in_game(game_id, user_id),
+              _team_claimed(TeamSlots.team_id) < _team_capacity(TeamSlots.team_id)). \
+        values(user_id=user_id). \
+        returning(TeamSlots.id, TeamSlots.team_id). \
+        execution_options(synchronize_session=False)
+    try:
+        row = db.execute(statement).first()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+    return row
+
+
+def join_game(db, game_id, user_id, team_id=None):
+    # Fill the team with the fewest players first; SKIP LOCKED moves past slots other joins are taking
+    candidate = select(TeamSlots.id). \
+        where(TeamSlots.user_id.is_(None),
+              TeamSlots.game_id == game_id,
+              _team_claimed(TeamSlots.team_id) < _team_capacity(TeamSlots.team_id))
+    if team_id is not None:
+        candidate = candidate.where(TeamSlots.team_id == team_id)
+    candidate = candidate.order_by(_team_claimed(TeamSlots.team_id), TeamSlots.id). \
+        limit(1).with_for_update(skip_locked=True)
+    slot_id = db.execute(candidate).scalar()
+    if slot_id is None:
+        db.rollback()
+        return None
+    return claim_slot(db, game_id, user_id, slot_id)
+
+
+def release_slot(db, game_id, user_id):
+    statement = update(TeamSlots). \
+        where(TeamSlots.user_id == user_id, TeamSlots.game_id == game_id). \
+        values(user_id=None). \
+        execution_options(synchronize_session=False)
+    released = db.execute(statement).rowcount
+    db.commit()
+    return released
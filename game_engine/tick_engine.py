@@ -0,0 +1,199 @@
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func
+
+from app_tasks.log_writer import log_app_event
+from config import GAME_STATE_CHECKPOINT_INTERVAL, TRAJECTORY_MIN_DISTANCE
+from database import SessionLocal
+from game_engine.game_state import NO_ZONE, GameState
+from game_engine.live import live_hub
+from game_engine.location_store import append_location_events, next_tick
+from game_engine.zone_index import build_zone_index, get_zone_index
+from models import InGameLocationEvents
+
+
+class TickEngine:
+    def __init__(self, game_id, last_tick=0, state=None, checkpoint_interval=GAME_STATE_CHECKPOINT_INTERVAL,
+                 min_distance=TRAJECTORY_MIN_DISTANCE):
+        self.game_id = game_id
+        self.tick_id = last_tick
+        self.state = state or GameState(game_id)
+        self.checkpoint_interval = checkpoint_interval
+        self.min_distance = min_distance
+        self._last_checkpoint = time.monotonic()
+        self._lock = threading.Lock()
+        self._reports = {}
+
+    def report(self, user_id, latitude, longitude, timestamp=None):
+        # Only the newest report of a player counts within one tick
+        with self._lock:
+            self._reports[user_id] = (latitude, longitude, timestamp or datetime.now())
+
+    def pending(self):
+        return len(self._reports)
+
+    def _take_reports(self):
+        with self._lock:
+            reports, self._reports = self._reports, {}
+        return reports
+
+    def _restore_reports(self, reports):
+        # Reports that arrived while the failed tick ran are newer and win
+        with self._lock:
+            for user_id, report in reports.items():
+                self._reports.setdefault(user_id, report)
+
+    def flush(self, db):
+        reports = self._take_reports()
+        if not reports:
+            if self.state.dirty.any():
+                self.checkpoint(db)
+            return None
+        user_ids = list(reports)
+        lats = np.fromiter((reports[user_id][0] for user_id in user_ids), dtype=np.float64, count=len(user_ids))
+        lons = np.fromiter((reports[user_id][1] for user_id in user_ids), dtype=np.float64, count=len(user_ids))
+        timestamps = [reports[user_id][2] for user_id in user_ids]
+
+        # Nothing in memory changes until the events are committed, so a failed tick is simply retried
+        try:
+            index = get_zone_index(self.game_id) or build_zone_index(db, self.game_id)
+            zones = index.classify(lats, lons)
+            rows = self.state.rows(user_ids)
+            # Players standing still are not logged again until they move TRAJECTORY_MIN_DISTANCE metres
+            moved = self.state.moved(rows, lats, lons, self.min_distance)
+            tick_id = next_tick(db, self.game_id, self.tick_id)
+            append_location_events(db, [{'user_id': user_ids[row],
+                                         'game_id': self.game_id,
+                                         'latitude': float(lats[row]),
+                                         'longitude': float(lons[row]),
+                                         'timestamp': timestamps[row],
+                                         'tick_id': tick_id}
+                                        for row in np.flatnonzero(moved).tolist()])
+            db.commit()
+        except Exception:
+            db.rollback()
+            self._restore_reports(reports)
+            raise
+
+        self.tick_id = tick_id
+        rows, previous = self.state.apply(user_ids, lats, lons, zones, timestamps)
+        self.state.mark_stored(rows[moved], lats[moved], lons[moved])
+        live_hub.publish(self.game_id, self._delta(index, user_ids, lats, lons, zones, previous))
+        # map_users is only a checkpoint of the in-memory state; the event log is written every tick
+        if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            try:
+                self.checkpoint(db)
+            except Exception as error:
+                # The tick itself is committed; the dirty rows stay marked for the next checkpoint
+                db.rollback()
+                log_app_event("tick_engine", f"Game {self.game_id} checkpoint failed: {error}")
+        return {'tick_id': tick_id, 'players': len(user_ids), 'stored': int(moved.sum())}
+
+    def checkpoint(self, db):
+        rows = self.state.checkpoint(db)
+        db.commit()
+        self.state.clean(rows)
+        self._last_checkpoint = time.monotonic()
+        return len(rows)
+
+    def _delta(self, index, user_ids, lats, lons, zones, previous):
+        previous_lats, previous_lons, previous_zones = previous
+        moved_rows = np.flatnonzero((previous_lats != lats) | (previous_lons != lons))
+        moved = [[user_ids[row], float(lats[row]), float(lons[row])] for row in moved_rows.tolist()]
+        zone_events = []
+        kill_timers = []
+        for row, layer in np.argwhere(previous_zones != zones).tolist():
+            user_id = user_ids[row]
+            for zone_id, action, timer_action in ((int(previous_zones[row, layer]), 'exit', 'cancel'),
+                                                  (int(zones[row, layer]), 'enter', 'start')):
+                if zone_id == NO_ZONE:
+                    continue
+                zone_events.append({'user_id': user_id, 'layer': layer, 'zone_id': zone_id, 'event': action})
+                zone = index.zone(layer, zone_id)
+                if layer <= 1 and zone is not None and zone.kill_timer:
+                    kill_timers.append({'user_id': user_id, 'layer': layer, 'zone_id': zone_id,
+                                        'seconds': zone.kill_timer, 'event': timer_action})
+        return {'type': 'tick',
+                'game_id': self.game_id,
+                'tick_id': self.tick_id,
+                'positions': moved,
+                'zones': zone_events,
+                'kill_timers': kill_timers}
+
+    def snapshot(self):
+        return {'type': 'snapshot',
+                'game_id': self.game_id,
+                'tick_id': self.tick_id,
+                'players': self.state.snapshot_rows()}
+
+
+# Engines live in the memory of one worker. All traffic of a game has to reach the same worker (run a
+# single worker, or route /game/{game_id} sticky by game id): reports sent to another worker would build
+# a second, partial state of the game. Tick ids come from game_ticks and stay unique either way.
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_tick_engine(db, game_id):
+    engine = _engines.get(game_id)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(game_id)
+            if engine is None:
+                last_tick = db.query(func.max(InGameLocationEvents.tick_id)). \
+                    filter(InGameLocationEvents.game_id == game_id).scalar()
+                engine = TickEngine(game_id, last_tick or 0, GameState(game_id).hydrate(db))
+                _engines[game_id] = engine
+    return engine
+
+
+def engine_metrics():
+    return {game_id: {'tick_id': engine.tick_id,
+                      'players': len(engine.state),
+                      'pending': engine.pending(),
+                      'state_bytes': engine.state.nbytes(),
+                      'subscribers': live_hub.subscribers(game_id)}
+            for game_id, engine in list(_engines.items())}
+
+
+def find_tick_engine(game_id):
+    return _engines.get(game_id)
+
+
+def drop_tick_engine(game_id):
+    _engines.pop(game_id, None)
+
+
+def process_ticks():
+    # One failing game must not hold back the others; its reports wait for the next tick
+    results = {}
+    db = SessionLocal()
+    try:
+        for game_id, engine in list(_engines.items()):
+            try:
+                results[game_id] = engine.flush(db)
+            except Exception as error:
+                log_app_event("tick_engine", f"Game {game_id} tick failed: {error}")
+                results[game_id] = None
+    finally:
+        db.close()
+    return results
+
+
+def checkpoint_games():
+    results = {}
+    db = SessionLocal()
+    try:
+        for game_id, engine in list(_engines.items()):
+            try:
+                results[game_id] = engine.checkpoint(db)
+            except Exception as error:
+                db.rollback()
+                log_app_event("tick_engine", f"Game {game_id} checkpoint failed: {error}")
+                results[game_id] = None
+        return results
+    finally:
+        db.close()
@@ -0,0 +1,178 @@
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+from sqlalchemy import Integer, func, select, type_coerce
+
+from config import TRAJECTORY_TOLERANCE, ARCHIVE_GAME_STATUS
+from database import upsert
+from game_engine.location_store import REPLAY_BATCH, drop_partition
+from game_engine.zone_index import EARTH_RADIUS
+from models import COORDINATE_SCALE, Games, GameStatus, InGameLocationEvents, PlayerTrajectories
+
+FORMAT_VERSION = 1
+TRAJECTORY_FIELDS = 4  # tick, timestamp (ms), latitude, longitude (microdegrees)
+
+
+def simplify(lats, lons, tolerance=TRAJECTORY_TOLERANCE):
+    # Douglas-Peucker on a local metric projection; returns a keep mask, end points are always kept
+    count = len(lats)
+    keep = np.zeros(count, dtype=bool)
+    if count <= 2 or tolerance <= 0:
+        keep[:] = True
+        return keep
+    y = np.radians(lats) * EARTH_RADIUS
+    x = np.radians(lons) * EARTH_RADIUS * np.cos(np.radians(np.mean(lats)))
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            offsets = np.hypot(px, py)
+        else:
+            offsets = np.abs(px * dy - py * dx) / length
+        worst = int(np.argmax(offsets))
+        if offsets[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+
+def _unzigzag(values):
+    return (values >> 1) ^ -(values & 1)
+
+
+def encode(ticks, timestamps, lats, lons):
+    # Column deltas, zigzag mapped and written as varints: a still or slow player costs a few bytes per point
+    columns = np.stack([np.asarray(ticks, dtype=np.int64),
+                        np.asarray(timestamps, dtype=np.int64),
+                        np.rint(np.asarray(lats) * COORDINATE_SCALE).astype(np.int64),
+                        np.rint(np.asarray(lons) * COORDINATE_SCALE).astype(np.int64)], axis=1)
+    deltas = np.diff(columns, axis=0, prepend=np.zeros((1, TRAJECTORY_FIELDS), dtype=np.int64))
+    out = bytearray([FORMAT_VERSION])
+    _write_varint(out, len(columns))
+    for value in _zigzag(deltas).ravel().tolist():
+        _write_varint(out, value)
+    return bytes(out)
+
+
+def decode(data):
+    if not data or data[0] != FORMAT_VERSION:
+        raise ValueError('Unknown trajectory format')
+    count, position = _read_varint(data, 1)
+    values = np.empty(count * TRAJECTORY_FIELDS, dtype=np.int64)
+    for i in range(len(values)):
+        values[i], position = _read_varint(data, position)
+    columns = np.cumsum(_unzigzag(values).reshape(count, TRAJECTORY_FIELDS), axis=0)
+    return (columns[:, 0], columns[:, 1],
+            columns[:, 2] / COORDINATE_SCALE, columns[:, 3] / COORDINATE_SCALE)
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def to_points(ticks, timestamps, lats, lons):
+    return [[tick, datetime.fromtimestamp(timestamp / 1000), lat, lon]
+            for tick, timestamp, lat, lon in zip(ticks.tolist(), timestamps.tolist(), lats.tolist(), lons.tolist())]
+
+
+def _event_rows(db, game_id, user_id=None):
+    query = select(InGameLocationEvents.user_id,
+                   InGameLocationEvents.tick_id,
+                   InGameLocationEvents.timestamp,
+                   type_coerce(InGameLocationEvents.latitude, Integer),
+                   type_coerce(InGameLocationEvents.longitude, Integer)) \
+        .where(InGameLocationEvents.game_id == game_id)
+    if user_id is not None:
+        query = query.where(InGameLocationEvents.user_id == user_id)
+    # Streamed in batches; only one player's history is held in memory at a time
+    return db.execute(query.order_by(InGameLocationEvents.user_id, InGameLocationEvents.tick_id)
+                      .execution_options(yield_per=REPLAY_BATCH))
+
+
+def _split_players(rows):
+    for user_id, player_rows in groupby(rows, key=itemgetter(0)):
+        player_rows = list(player_rows)
+        ticks = np.array([row[1] for row in player_rows], dtype=np.int64)
+        timestamps = np.array([int(row[2].timestamp() * 1000) if row[2] else 0 for row in player_rows],
+                              dtype=np.int64)
+        raw = np.array([row[3:] for row in player_rows], dtype=np.float64).reshape(-1, 2) / COORDINATE_SCALE
+        yield user_id, ticks, timestamps, raw[:, 0], raw[:, 1]
+
+
+def live_trajectory(db, game_id, user_id):
+    with _event_rows(db, game_id, user_id) as rows:
+        for _, ticks, timestamps, lats, lons in _split_players(rows):
+            return ticks, timestamps, lats, lons
+    return None
+
+
+def stored_trajectory(db, game_id, user_id):
+    data = db.execute(select(PlayerTrajectories.data)
+                      .where(PlayerTrajectories.game_id == game_id, PlayerTrajectories.user_id == user_id)).scalar()
+    if data is None:
+        return None
+    return decode(data)
+
+
+def archive_game(db, game_id, tolerance=TRAJECTORY_TOLERANCE):
+    # Simplify and encode every player's history, then drop the raw rows of the game in the same transaction
+    trajectories = []
+    raw_points = 0
+    for user_id, ticks, timestamps, lats, lons in _split_players(_event_rows(db, game_id)):
+        keep = simplify(lats, lons, tolerance)
+        raw_points += len(ticks)
+        trajectories.append({'game_id': game_id,
+                             'user_id': user_id,
+                             'raw_points': len(ticks),
+                             'points': int(keep.sum()),
+                             'tolerance': tolerance,
+                             'first_tick': int(ticks[0]),
+                             'last_tick': int(ticks[-1]),
+                             'data': encode(ticks[keep], timestamps[keep], lats[keep], lons[keep]),
+                             'created': datetime.now()})
+    if trajectories:
+        upsert(db, PlayerTrajectories, trajectories,
+               index_elements=['game_id', 'user_id'],
+               update_columns=['raw_points', 'points', 'tolerance', 'first_tick', 'last_tick', 'data', 'created'])
+    drop_partition(db, game_id)
+    db.commit()
+    return {'players': len(trajectories),
+            'raw_points': raw_points,
+            'points': sum(trajectory['points'] for trajectory in trajectories)}
+
+
+def games_to_archive(db):
+    has_events = select(InGameLocationEvents.game_id).where(InGameLocationEvents.game_id == Games.id).exists()
+    archived = select(Games.id) \
+        .join(GameStatus, GameStatus.id == Games.game_status_id) \
+        .where(func.lower(GameStatus.status_name) == ARCHIVE_GAME_STATUS.lower(), has_events)
+    return db.execute(archived).scalars().all()
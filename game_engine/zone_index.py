@@ -0,0 +1,321 @@
+import json
+import math
+import re
+import threading
+from bisect import insort
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from database import on_commit
+from models import MapLayer0, MapLayer1, MapLayer2, MapLayer3
+from reference_data import reference_cache
+
+LAYER_MODELS = (MapLayer0, MapLayer1, MapLayer2, MapLayer3)
+LAYER_FIELDS = ('layer_0_zone', 'layer_1_zone', 'layer_2_zone', 'layer_3_zone')
+
+GRID_CELLS = 64
+EARTH_RADIUS = 6371000.0
+
+_circle_re = re.compile(r'\[\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\]\s*,\s*\{\s*"?radius"?\s*:\s*([\d.]+)\s*\}')
+
+
+class Zone:
+    __slots__ = ('id', 'layer', 'kind', 'min_lat', 'min_lon', 'max_lat', 'max_lon',
+                 'points', 'center', 'radius', 'kill_timer')
+
+    def __init__(self, zone_pk, layer, kind, points=None, center=None, radius=None, kill_timer=None):
+        self.id = zone_pk
+        self.layer = layer
+        self.kind = kind
+        self.kill_timer = kill_timer
+        self.points = points
+        self.center = center
+        self.radius = radius
+        if kind == 'polygon':
+            lats = [p[0] for p in points]
+            lons = [p[1] for p in points]
+            self.min_lat, self.max_lat = min(lats), max(lats)
+            self.min_lon, self.max_lon = min(lons), max(lons)
+        else:
+            d_lat = math.degrees(radius / EARTH_RADIUS)
+            d_lon = d_lat / max(math.cos(math.radians(center[0])), 1e-6)
+            self.min_lat, self.max_lat = center[0] - d_lat, center[0] + d_lat
+            self.min_lon, self.max_lon = center[1] - d_lon, center[1] + d_lon
+
+    def contains(self, lat, lon):
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon):
+            return False
+        if self.kind == 'circle':
+            return distance(lat, lon, self.center[0], self.center[1]) <= self.radius
+        inside = False
+        points = self.points
+        j = len(points) - 1
+        for i in range(len(points)):
+            lat_i, lon_i = points[i]
+            lat_j, lon_j = points[j]
+            if (lon_i > lon) != (lon_j > lon) and \
+                    lat < (lat_j - lat_i) * (lon - lon_i) / (lon_j - lon_i) + lat_i:
+                inside = not inside
+            j = i
+        return inside
+
+    def contains_many(self, lats, lons):
+        mask = (lats >= self.min_lat) & (lats <= self.max_lat) & (lons >= self.min_lon) & (lons <= self.max_lon)
+        candidates = np.flatnonzero(mask)
+        if not candidates.size:
+            return mask
+        lat, lon = lats[candidates], lons[candidates]
+        if self.kind == 'circle':
+            x = np.radians(lon - self.center[1]) * np.cos(np.radians((lat + self.center[0]) / 2))
+            y = np.radians(lat - self.center[0])
+            mask[candidates] = np.hypot(x, y) * EARTH_RADIUS <= self.radius
+            return mask
+        inside = np.zeros(candidates.size, dtype=bool)
+        points = self.points
+        j = len(points) - 1
+        for i in range(len(points)):
+            lat_i, lon_i = points[i]
+            lat_j, lon_j = points[j]
+            if lon_i != lon_j:
+                crosses = ((lon_i > lon) != (lon_j > lon)) & \
+                          (lat < (lat_j - lat_i) * (lon - lon_i) / (lon_j - lon_i) + lat_i)
+                inside ^= crosses
+            j = i
+        mask[candidates] = inside
+        return mask
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Equirectangular approximation, accurate enough for zones of a few kilometres
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * EARTH_RADIUS
+
+
+def distances(lat1, lon1, lat2, lon2):
+    # Vectorized form of distance for arrays of points
+    x = np.radians(lon2 - lon1) * np.cos(np.radians((lat1 + lat2) / 2))
+    y = np.radians(lat2 - lat1)
+    return np.hypot(x, y) * EARTH_RADIUS
+
+
+def parse_shape(shape_type: str, zone_shape: str):
+    kind = (shape_type or '').strip().lower()
+    if kind == 'polygon':
+        points = [(float(p[0]), float(p[1])) for p in json.loads(zone_shape)]
+        if len(points) < 3:
+            raise ValueError(f"Polygon needs at least 3 points: {zone_shape}")
+        return kind, {'points': points}
+    if kind == 'circle':
+        match = _circle_re.search(zone_shape or '')
+        if not match:
+            raise ValueError(f"Invalid circle shape: {zone_shape}")
+        lat, lon, radius = (float(value) for value in match.groups())
+        return kind, {'center': (lat, lon), 'radius': radius}
+    raise ValueError(f"Unsupported shape type: {shape_type}")
+
+
+class ZoneIndex:
+    def __init__(self, game_id, zones, cells=GRID_CELLS, shape_types=None):
+        self.game_id = game_id
+        self.shape_types = shape_types or {}
+        self.cells = cells
+        self._lock = threading.Lock()
+        self._zones = {}
+        if zones:
+            self.min_lat = min(zone.min_lat for zone in zones)
+            self.min_lon = min(zone.min_lon for zone in zones)
+            self.max_lat = max(zone.max_lat for zone in zones)
+            self.max_lon = max(zone.max_lon for zone in zones)
+        else:
+            self.min_lat = self.min_lon = 0.0
+            self.max_lat = self.max_lon = 1.0
+        self.cell_lat = max(self.max_lat - self.min_lat, 1e-9) / cells
+        self.cell_lon = max(self.max_lon - self.min_lon, 1e-9) / cells
+        self._grid = {}
+        self._flat = None
+        # Buckets are filled in id order once here; later upserts insert in place
+        for zone in sorted(zones, key=lambda item: item.id):
+            self._insert(zone)
+
+    def _cell(self, lat, lon):
+        row = int((lat - self.min_lat) / self.cell_lat)
+        col = int((lon - self.min_lon) / self.cell_lon)
+        return min(max(row, 0), self.cells - 1), min(max(col, 0), self.cells - 1)
+
+    def _cells_for(self, zone):
+        row_0, col_0 = self._cell(zone.min_lat, zone.min_lon)
+        row_1, col_1 = self._cell(zone.max_lat, zone.max_lon)
+        for row in range(row_0, row_1 + 1):
+            for col in range(col_0, col_1 + 1):
+                yield row, col
+
+    def _insert(self, zone):
+        self._zones[(zone.layer, zone.id)] = zone
+        self._flat = None
+        for cell in self._cells_for(zone):
+            bucket = self._grid.setdefault(cell, ([], [], [], []))
+            insort(bucket[zone.layer], zone, key=lambda item: item.id)
+
+    def _remove(self, layer, zone_pk):
+        zone = self._zones.pop((layer, zone_pk), None)
+        if zone is None:
+            return
+        self._flat = None
+        for cell in self._cells_for(zone):
+            bucket = self._grid.get(cell)
+            if bucket is not None:
+                bucket[layer][:] = [item for item in bucket[layer] if item.id != zone_pk]
+
+    def upsert_zone(self, zone):
+        with self._lock:
+            self._remove(zone.layer, zone.id)
+            self._insert(zone)
+
+    def remove_zone(self, layer, zone_pk):
+        with self._lock:
+            self._remove(layer, zone_pk)
+
+    def zones(self):
+        return list(self._zones.values())
+
+    def zone(self, layer, zone_pk):
+        return self._zones.get((layer, zone_pk))
+
+    def locate(self, lat, lon):
+        bucket = self._grid.get(self._cell(lat, lon))
+        result = dict.fromkeys(LAYER_FIELDS)
+        if bucket is None:
+            return result
+        for layer, layer_zones in enumerate(bucket):
+            for zone in layer_zones:
+                if zone.contains(lat, lon):
+                    result[LAYER_FIELDS[layer]] = zone.id
+                    break
+        return result
+
+    def _candidates(self):
+        # Flat copy of the grid for classify(), rebuilt after zone changes: the zones of cell c are
+        # members[starts[c]:starts[c + 1]], as positions in a zone list sorted by descending id
+        zones = sorted(self._zones.values(), key=lambda item: item.id, reverse=True)
+        position = {(zone.layer, zone.id): index for index, zone in enumerate(zones)}
+        cells, members = [], []
+        for (row, col), bucket in self._grid.items():
+            for layer_zones in bucket:
+                for zone in layer_zones:
+                    cells.append(row * self.cells + col)
+                    members.append(position[(zone.layer, zone.id)])
+        cells = np.array(cells, dtype=np.int64)
+        order = np.argsort(cells, kind='stable')
+        starts = np.searchsorted(cells[order], np.arange(self.cells * self.cells + 1))
+        return zones, np.array(members, dtype=np.int64)[order], starts
+
+    def classify(self, lats, lons):
+        # Vectorized locate() for a whole tick; 0 marks "no zone" in the returned (n, 4) array.
+        # Each zone is only tested against the points that fall into its grid cells.
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.zeros((lats.size, len(LAYER_FIELDS)), dtype=np.int64)
+        if not lats.size:
+            return result
+        with self._lock:
+            if self._flat is None:
+                self._flat = self._candidates()
+            zones, members, starts = self._flat
+        rows = np.clip(((lats - self.min_lat) // self.cell_lat).astype(np.int64), 0, self.cells - 1)
+        cols = np.clip(((lons - self.min_lon) // self.cell_lon).astype(np.int64), 0, self.cells - 1)
+        cells = rows * self.cells + cols
+        first, counts = starts[cells], starts[cells + 1] - starts[cells]
+        total = int(counts.sum())
+        if not total:
+            return result
+        # One (point, zone) pair per zone in the point's cell, grouped by zone
+        points = np.repeat(np.arange(lats.size), counts)
+        slots = members[np.repeat(first - (np.cumsum(counts) - counts), counts) + np.arange(total)]
+        order = np.argsort(slots, kind='stable')
+        slots, points = slots[order], points[order]
+        used, bounds = np.unique(slots, return_index=True)
+        # Zones go by descending id, so where zones of one layer overlap the lowest id is written last,
+        # the same rule locate() applies
+        for slot, zone_points in zip(used.tolist(), np.split(points, bounds[1:])):
+            zone = zones[slot]
+            inside = zone_points[zone.contains_many(lats[zone_points], lons[zone_points])]
+            result[inside, zone.layer] = zone.id
+        return result
+
+
+_indexes = {}
+
+
+def zone_from_row(layer, row, shape_types):
+    kind, geometry = parse_shape(shape_types.get(row.shape_type), row.zone_shape)
+    return Zone(row.id, layer, kind, kill_timer=getattr(row, 'kill_timer', None), **geometry)
+
+
+def build_zone_index(db, game_id):
+    shape_types = reference_cache.mapping(db, 'shape_types', 'id', 'type')
+    zones = []
+    for layer, model in enumerate(LAYER_MODELS):
+        for row in db.query(model).filter(model.game_id == game_id).all():
+            try:
+                zones.append(zone_from_row(layer, row, shape_types))
+            except (ValueError, TypeError, IndexError):
+                continue
+    index = ZoneIndex(game_id, zones, shape_types=shape_types)
+    _indexes[game_id] = index
+    return index
+
+
+def get_zone_index(game_id):
+    return _indexes.get(game_id)
+
+
+def drop_zone_index(game_id):
+    _indexes.pop(game_id, None)
+
+
+def _zone_changed(mapper, connection, target):
+    # The zone is parsed now, while the row is at hand, but only enters the index once the change commits
+    layer = LAYER_MODELS.index(type(target))
+    game_id, zone_pk = target.game_id, target.id
+    index = _indexes.get(game_id)
+    zone = None
+    if index is not None:
+        try:
+            zone = zone_from_row(layer, target, index.shape_types)
+        except (ValueError, TypeError, IndexError):
+            pass
+
+    def apply():
+        current = _indexes.get(game_id)
+        if current is None:
+            return
+        if index is None:
+            # Built after the flush, possibly without this row; the next tick rebuilds it
+            drop_zone_index(game_id)
+        elif zone is None:
+            current.remove_zone(layer, zone_pk)
+        else:
+            current.upsert_zone(zone)
+
+    on_commit(object_session(target), apply)
+
+
+def _zone_deleted(mapper, connection, target):
+    layer = LAYER_MODELS.index(type(target))
+    game_id, zone_pk = target.game_id, target.id
+
+    def apply():
+        index = _indexes.get(game_id)
+        if index is not None:
+            index.remove_zone(layer, zone_pk)
+
+    on_commit(object_session(target), apply)
+
+
+for _model in LAYER_MODELS:
+    event.listen(_model, 'after_insert', _zone_changed)
+    event.listen(_model, 'after_update', _zone_changed)
+    event.listen(_model, 'after_delete', _zone_deleted)
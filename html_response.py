@@ -1,23 +1,68 @@
-from typing import Annotated
+import hashlib
+import os
+import threading
+from string import Template
 
-from fastapi import Depends
-from sqlalchemy.orm import Session
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, Response
 
-from database import SessionLocal
+from config import TEMPLATE_DIR, TEMPLATE_HOT_RELOAD, STATIC_PAGE_MAX_AGE
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+class CompiledTemplate:
+    __slots__ = ('template', 'content', 'etag', 'mtime')
 
+    def __init__(self, content, mtime):
+        self.template = Template(content)
+        self.content = content
+        self.etag = '"' + hashlib.sha1(content.encode()).hexdigest() + '"'
+        self.mtime = mtime
 
-db_dependency = Annotated[Session, Depends(get_db)]
 
+class TemplateStore:
+    def __init__(self, root=TEMPLATE_DIR, hot_reload=TEMPLATE_HOT_RELOAD):
+        self.root = root
+        self.hot_reload = hot_reload
+        self._templates = {}
+        self._lock = threading.Lock()
 
-def email_confirmed():
-    with open("html/confirm_email_thankyou.html", "r") as file:
-        html_content = file.read()
-    return html_content
+    def _path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def _load(self, name):
+        path = self._path(name)
+        with open(path, "r", encoding="utf-8") as file:
+            content = file.read()
+        compiled = CompiledTemplate(content, os.path.getmtime(path))
+        with self._lock:
+            self._templates[name] = compiled
+        return compiled
+
+    def preload(self):
+        for directory, _, files in os.walk(self.root):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), self.root).replace(os.sep, '/')
+                self._load(name)
+        return len(self._templates)
+
+    def get(self, name):
+        compiled = self._templates.get(name)
+        if compiled is None:
+            return self._load(name)
+        if self.hot_reload and os.path.getmtime(self._path(name)) != compiled.mtime:
+            return self._load(name)
+        return compiled
+
+    def render(self, name, **values):
+        return self.get(name).template.safe_substitute(values)
+
+
+templates = TemplateStore()
+
+
+def static_page(request: Request, name: str):
+    page = templates.get(name)
+    headers = {'ETag': page.etag, 'Cache-Control': f'public, max-age={STATIC_PAGE_MAX_AGE}'}
+    if request.headers.get('if-none-match') == page.etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=page.content, headers=headers)
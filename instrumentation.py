@@ -0,0 +1,215 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app_tasks.log_writer import log_app_event
+from database import PoolStats
+from config import INSTRUMENTATION, SLOW_REQUEST_MS, SLOW_REQUEST_MAX_QUERIES
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    __slots__ = ('queries', 'sql_count', 'sql_seconds', 'pool_wait_seconds', 'external')
+
+    def __init__(self):
+        self.queries = []
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.external = {}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.sql = {}
+        self.pool_wait = Histogram()
+        self.external = {}
+
+    def _observe(self, family, key, value):
+        with self._lock:
+            histogram = family.get(key)
+            if histogram is None:
+                histogram = family[key] = Histogram()
+            histogram.observe(value)
+
+    def request(self, method, route, status_code, seconds):
+        self._observe(self.requests, (method, route, str(status_code)), seconds)
+
+    def statement(self, operation, seconds):
+        self._observe(self.sql, (operation,), seconds)
+
+    def waited(self, seconds):
+        with self._lock:
+            self.pool_wait.observe(seconds)
+
+    def external_call(self, name, seconds):
+        self._observe(self.external, (name,), seconds)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            families = (('http_request_duration_seconds', ('method', 'route', 'status'), self.requests),
+                        ('db_statement_duration_seconds', ('operation',), self.sql),
+                        ('db_pool_wait_seconds', (), {(): self.pool_wait}),
+                        ('external_call_duration_seconds', ('target',), self.external))
+            for name, labels, family in families:
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(family.items()):
+                    pairs = [f'{label}="{_escape(value)}"' for label, value in zip(labels, key)]
+                    cumulative = 0
+                    for bound, count in zip((*histogram.buckets, '+Inf'), histogram.counts):
+                        cumulative += count
+                        bucket = ','.join([*pairs, f'le="{bound}"'])
+                        lines.append(f"{name}_bucket{{{bucket}}} {cumulative}")
+                    suffix = f"{{{','.join(pairs)}}}" if pairs else ''
+                    lines.append(f"{name}_sum{suffix} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{suffix} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def external_call(name):
+    # Times a call leaving the process (SMTP, HTTP lookups); a no-op unless instrumentation is installed
+    if not metrics.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.external_call(name, seconds)
+        timing = _current.get()
+        if timing is not None:
+            timing.external[name] = timing.external.get(name, 0.0) + seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    seconds = time.perf_counter() - started
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+    metrics.statement(operation, seconds)
+    timing = _current.get()
+    if timing is not None:
+        timing.sql_count += 1
+        timing.sql_seconds += seconds
+        if len(timing.queries) < SLOW_REQUEST_MAX_QUERIES:
+            timing.queries.append((seconds, ' '.join(statement.split())))
+
+
+def _handle_error(context):
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _pool_waited(seconds):
+    metrics.waited(seconds)
+    timing = _current.get()
+    if timing is not None:
+        timing.pool_wait_seconds += seconds
+
+
+def _route_templates(app):
+    return {route.endpoint: route.path for route in app.routes if hasattr(route, 'endpoint')}
+
+
+class InstrumentationMiddleware:
+    def __init__(self, app, slow_request_ms=SLOW_REQUEST_MS):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+        self._routes = None
+
+    def _route(self, scope):
+        if self._routes is None:
+            self._routes = _route_templates(scope['app'])
+        return self._routes.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timing = RequestTiming()
+        token = _current.set(timing)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                total = (time.perf_counter() - started) * 1000
+                entries = [f"db;desc=\"{timing.sql_count} queries\";dur={timing.sql_seconds * 1000:.1f}",
+                           f"pool;dur={timing.pool_wait_seconds * 1000:.1f}",
+                           *(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timing.external.items()),
+                           f"app;dur={total:.1f}"]
+                message.setdefault('headers', []).append((b'server-timing', ', '.join(entries).encode('latin-1')))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            seconds = time.perf_counter() - started
+            route = self._route(scope)
+            metrics.request(scope['method'], route, status_code, seconds)
+            if seconds * 1000 >= self.slow_request_ms:
+                _log_slow_request(scope['method'], route, status_code, seconds, timing)
+
+
+def _log_slow_request(method, route, status_code, seconds, timing):
+    queries = '\n'.join(f"{query_seconds * 1000:.1f} ms  {statement}" for query_seconds, statement in timing.queries)
+    log_app_event("slow_request",
+                  f"{method} {route} {status_code} {seconds * 1000:.1f} ms, "
+                  f"{timing.sql_count} queries {timing.sql_seconds * 1000:.1f} ms, "
+                  f"pool wait {timing.pool_wait_seconds * 1000:.1f} ms\n{queries}")
+
+
+def install(app, enabled=INSTRUMENTATION):
+    if not enabled:
+        return False
+    if not metrics.enabled:
+        # Listening on the Engine class covers engines created later, including the async engine's sync core
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        PoolStats.observers.append(_pool_waited)
+        metrics.enabled = True
+    app.add_middleware(InstrumentationMiddleware)
+    return True
@@ -1,37 +1,62 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from fastapi import FastAPI
-import models
-from app_tasks import scheduled_services
-from app_tasks.startup import main_app_log, process_services
-
-from database import engine
-from routers import auth, game
-
-app = FastAPI()
-
-models.Base.metadata.create_all(bind=engine)
+import time
+from contextlib import asynccontextmanager
 
-scheduler = BackgroundScheduler()
-
-app.include_router(auth.router)
-app.include_router(game.router)
-
-
-@app.on_event("startup")
-async def startup_event():
-    main_app_log("Main App", "START")
-    service_dict = process_services()
-    if service_dict is not None:
-        for service_name, service_interval in service_dict.items():
-            service_func = getattr(scheduled_services, service_name)
-            scheduler.add_job(service_func, 'interval', seconds=service_interval)
-        scheduler.print_jobs()
-        main_app_log("Scheduler", f"START. Services: {len(service_dict)}")
-    scheduler.start()
+from fastapi import FastAPI
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    scheduler.shutdown()
-    main_app_log("Main App", "STOP")
-    main_app_log("Scheduler", "STOP")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from app_tasks.log_writer import log_writer
+    from app_tasks.runner import service_runner
+    from app_tasks.startup import main_app_log
+    from database import dispose_engines, get_async_engine, get_engine
+    from game_engine.tick_engine import checkpoint_games
+    from html_response import templates
+    from sendmail import mail_outbox
+
+    started = time.perf_counter()
+    # Engines are built here once per worker; connections still open on first use
+    get_engine()
+    get_async_engine()
+    log_writer.start()
+    templates.preload()
+    mail_outbox.start()
+    app.state.boot_seconds = time.perf_counter() - started
+    main_app_log("Main App", f"START import {app.state.import_seconds:.3f}s boot {app.state.boot_seconds:.3f}s")
+    service_runner.start()
+    main_app_log("Scheduler", "START")
+    try:
+        yield
+    finally:
+        await service_runner.stop()
+        checkpoint_games()
+        mail_outbox.stop()
+        main_app_log("Main App", "STOP")
+        main_app_log("Scheduler", "STOP")
+        log_writer.stop()
+        await dispose_engines()
+
+
+def create_app():
+    # Schema creation and migrations are not part of startup: run `python manage.py init-db` once
+    started = time.perf_counter()
+    from instrumentation import install as install_instrumentation
+    from routers import auth, game, notifications, service
+
+    app = FastAPI(lifespan=lifespan)
+    install_instrumentation(app)
+    app.include_router(auth.router)
+    app.include_router(game.router)
+    app.include_router(notifications.router)
+    app.include_router(service.router)
+    app.state.import_seconds = time.perf_counter() - started
+    app.state.boot_seconds = None
+    return app
+
+
+def __getattr__(name):
+    # `uvicorn main:app` still works; the app is only built when it is asked for
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
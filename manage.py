@@ -0,0 +1,104 @@
+"""One-off administration commands.
+
+    python manage.py init-db [--fake-migrations]   create the schema and apply pending migrations
+    python manage.py boot-time                     measure import and worker boot time
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, MetaData, String, Table, TIMESTAMP, inspect, select
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Kept out of models.Base so the application never creates or reads it
+schema_migrations = Table('schema_migrations', MetaData(),
+                          Column('name', String, primary_key=True),
+                          Column('applied', TIMESTAMP))
+
+
+def migration_files():
+    return sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith('.sql'))
+
+
+def run_sql_file(connection, path):
+    with open(path) as file:
+        script = file.read()
+    # The raw DBAPI cursor accepts the multi-statement scripts, including DO blocks
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(script)
+    finally:
+        cursor.close()
+
+
+def init_db(fake_migrations=False):
+    import models
+    from database import get_engine
+
+    db_engine = get_engine()
+    fresh = not inspect(db_engine).has_table('users')
+    schema_migrations.create(db_engine, checkfirst=True)
+    with db_engine.begin() as connection:
+        applied = set(connection.execute(select(schema_migrations.c.name)).scalars())
+    pending = [name for name in migration_files() if name not in applied]
+    # A fresh database gets the current schema from the models; the migrations only upgrade older ones
+    run_migrations = not fresh and not fake_migrations and db_engine.dialect.name == 'postgresql'
+    for name in pending:
+        if run_migrations:
+            print(f"Applying {name}")
+            with db_engine.begin() as connection:
+                run_sql_file(connection, os.path.join(MIGRATIONS_DIR, name))
+        with db_engine.begin() as connection:
+            connection.execute(schema_migrations.insert(), {'name': name, 'applied': datetime.now()})
+    models.Base.metadata.create_all(bind=db_engine)
+    print(f"Schema ready ({'created' if fresh else 'updated'}), "
+          f"{len(pending)} migration(s) {'applied' if run_migrations else 'recorded'}")
+
+
+async def _boot(app):
+    started = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        booted = time.perf_counter() - started
+        from database import get_engine
+        from sqlalchemy import text
+        connect_started = time.perf_counter()
+        with get_engine().connect() as connection:
+            connection.execute(text('SELECT 1'))
+        first_query = time.perf_counter() - connect_started
+    return booted, first_query
+
+
+def boot_time():
+    started = time.perf_counter()
+    import main
+    main_import = time.perf_counter() - started
+    app = main.create_app()
+    booted, first_query = asyncio.run(_boot(app))
+    print(f"import main        {main_import * 1000:9.1f} ms")
+    print(f"create_app         {app.state.import_seconds * 1000:9.1f} ms")
+    print(f"lifespan startup   {booted * 1000:9.1f} ms")
+    print(f"first query        {first_query * 1000:9.1f} ms")
+    print(f"total              {(time.perf_counter() - started) * 1000:9.1f} ms")
+    print(f"modules loaded     {len(sys.modules):9d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    init = commands.add_parser('init-db', help='create tables and apply pending migrations')
+    init.add_argument('--fake-migrations', action='store_true',
+                      help='record pending migrations as applied without running them')
+    commands.add_parser('boot-time', help='measure import and startup time of one worker')
+    args = parser.parse_args()
+    if args.command == 'init-db':
+        init_db(args.fake_migrations)
+    elif args.command == 'boot-time':
+        boot_time()
+
+
+if __name__ == '__main__':
+    main()
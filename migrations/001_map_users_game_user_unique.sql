@@ -0,0 +1,7 @@
+-- One map_users row per player per game, required by the tick engine upsert.
+DELETE FROM map_users a
+    USING map_users b
+    WHERE a.game_id = b.game_id AND a.user_id = b.user_id AND a.id < b.id;
+
+ALTER TABLE map_users
+    ADD CONSTRAINT map_users_game_id_user_id_key UNIQUE (game_id, user_id);
@@ -0,0 +1,19 @@
+-- Latitude/longitude move from text to microdegree integers (models.Coordinate).
+-- Empty or blank strings become NULL.
+ALTER TABLE games
+    ALTER COLUMN game_lobby_lat TYPE INTEGER
+        USING round(NULLIF(trim(game_lobby_lat), '')::numeric * 1000000)::integer,
+    ALTER COLUMN game_lobby_lon TYPE INTEGER
+        USING round(NULLIF(trim(game_lobby_lon), '')::numeric * 1000000)::integer;
+
+ALTER TABLE map_users
+    ALTER COLUMN latitude TYPE INTEGER
+        USING round(NULLIF(trim(latitude), '')::numeric * 1000000)::integer,
+    ALTER COLUMN longitude TYPE INTEGER
+        USING round(NULLIF(trim(longitude), '')::numeric * 1000000)::integer;
+
+ALTER TABLE ingame_location_events
+    ALTER COLUMN latitude TYPE INTEGER
+        USING round(NULLIF(trim(latitude), '')::numeric * 1000000)::integer,
+    ALTER COLUMN longitude TYPE INTEGER
+        USING round(NULLIF(trim(longitude), '')::numeric * 1000000)::integer;
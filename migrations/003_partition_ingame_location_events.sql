@@ -0,0 +1,41 @@
+-- Rebuild ingame_location_events as a LIST-partitioned table (one partition per game)
+-- with (game_id, tick_id) and timestamp indexes. Existing rows are copied into per-game partitions.
+BEGIN;
+
+ALTER TABLE ingame_location_events RENAME TO ingame_location_events_old;
+
+CREATE TABLE ingame_location_events (
+    id BIGSERIAL NOT NULL,
+    user_id INTEGER REFERENCES users (id),
+    game_id INTEGER NOT NULL REFERENCES games (id),
+    latitude INTEGER,
+    longitude INTEGER,
+    timestamp TIMESTAMP WITHOUT TIME ZONE,
+    tick_id INTEGER,
+    PRIMARY KEY (id, game_id)
+) PARTITION BY LIST (game_id);
+
+CREATE TABLE ingame_location_events_default PARTITION OF ingame_location_events DEFAULT;
+
+DO $$
+DECLARE
+    old_game_id INTEGER;
+BEGIN
+    FOR old_game_id IN SELECT DISTINCT game_id FROM ingame_location_events_old WHERE game_id IS NOT NULL LOOP
+        EXECUTE format('CREATE TABLE ingame_location_events_g%s PARTITION OF ingame_location_events FOR VALUES IN (%s)',
+                       old_game_id, old_game_id);
+    END LOOP;
+END $$;
+
+CREATE INDEX ix_ingame_location_events_game_tick ON ingame_location_events (game_id, tick_id);
+CREATE INDEX ix_ingame_location_events_timestamp ON ingame_location_events (timestamp);
+
+INSERT INTO ingame_location_events (user_id, game_id, latitude, longitude, timestamp, tick_id)
+    SELECT user_id, game_id, latitude, longitude, timestamp, tick_id
+    FROM ingame_location_events_old
+    WHERE game_id IS NOT NULL
+    ORDER BY id;
+
+DROP TABLE ingame_location_events_old;
+
+COMMIT;
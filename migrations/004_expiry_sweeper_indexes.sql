@@ -0,0 +1,3 @@
+-- Indexes used by the expiry_sweeper scheduled service.
+CREATE INDEX IF NOT EXISTS ix_email_confirmation_expire_date ON email_confirmation (expire_date);
+CREATE INDEX IF NOT EXISTS ix_map_users_last_update ON map_users (last_update);
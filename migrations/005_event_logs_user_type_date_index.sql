@@ -0,0 +1,2 @@
+-- Supports per-user audit queries over event_logs by event type and date.
+CREATE INDEX IF NOT EXISTS ix_event_logs_user_type_date ON event_logs (user_id, event_type, event_date);
@@ -0,0 +1,15 @@
+-- Compressed per-player location history of archived games (see game_engine.trajectory).
+CREATE TABLE IF NOT EXISTS player_trajectories (
+    id SERIAL PRIMARY KEY,
+    game_id INTEGER REFERENCES games (id),
+    user_id INTEGER REFERENCES users (id),
+    raw_points INTEGER,
+    points INTEGER,
+    tolerance DOUBLE PRECISION,
+    first_tick INTEGER,
+    last_tick INTEGER,
+    data BYTEA,
+    created TIMESTAMP,
+    UNIQUE (game_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS ix_player_trajectories_id ON player_trajectories (id);
@@ -0,0 +1,17 @@
+-- Keyset-paginated notification feed and the per-user unread counter (see notifications.py).
+CREATE INDEX IF NOT EXISTS ix_user_notifications_user_new_date
+    ON user_notifications (user_id, is_new, notification_date);
+CREATE INDEX IF NOT EXISTS ix_user_notifications_user_date_id
+    ON user_notifications (user_id, notification_date, id);
+
+CREATE TABLE IF NOT EXISTS user_notification_counters (
+    user_id INTEGER PRIMARY KEY REFERENCES users (id),
+    unread INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO user_notification_counters (user_id, unread)
+    SELECT user_id, count(*)
+    FROM user_notifications
+    WHERE is_new AND is_visible AND user_id IS NOT NULL
+    GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE SET unread = EXCLUDED.unread;
@@ -0,0 +1,12 @@
+-- Tick ids are allocated from one counter row per game instead of per worker (see game_engine.location_store).
+CREATE TABLE IF NOT EXISTS game_ticks (
+    game_id INTEGER PRIMARY KEY REFERENCES games (id),
+    tick_id INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO game_ticks (game_id, tick_id)
+    SELECT game_id, max(tick_id)
+    FROM ingame_location_events
+    WHERE tick_id IS NOT NULL
+    GROUP BY game_id
+ON CONFLICT (game_id) DO UPDATE SET tick_id = GREATEST(game_ticks.tick_id, EXCLUDED.tick_id);
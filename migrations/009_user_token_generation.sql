@@ -0,0 +1,2 @@
+-- Token revocation counter shared by all workers (see token_cache.TokenRevocations).
+ALTER TABLE users ADD COLUMN IF NOT EXISTS token_generation INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,20 @@
+-- One slot per player per game, enforced by the database instead of a lock (see game_engine.slots).
+ALTER TABLE team_slots ADD COLUMN IF NOT EXISTS game_id INTEGER REFERENCES games (id);
+
+UPDATE team_slots
+SET game_id = teams.game_id
+FROM teams
+WHERE teams.id = team_slots.team_id AND team_slots.game_id IS NULL;
+
+-- Players already holding several slots of one game keep the lowest one
+UPDATE team_slots
+SET user_id = NULL
+WHERE id IN (SELECT id
+             FROM (SELECT id, row_number() OVER (PARTITION BY game_id, user_id ORDER BY id) AS position
+                   FROM team_slots
+                   WHERE user_id IS NOT NULL) AS ranked
+             WHERE position > 1);
+
+ALTER TABLE team_slots ALTER COLUMN game_id SET NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_team_slots_game_user
+    ON team_slots (game_id, user_id) WHERE user_id IS NOT NULL;
@@ -1,10 +1,29 @@
 import datetime
 
-from sqlalchemy import Column, String, TIMESTAMP, Boolean
-from sqlalchemy import Integer, ForeignKey
+from sqlalchemy import Column, String, TIMESTAMP, Boolean, UniqueConstraint, Float, LargeBinary
+from sqlalchemy import Integer, BigInteger, ForeignKey, Index, DDL, FetchedValue, event, text
+from sqlalchemy.types import TypeDecorator
 
 from database import Base
 
+COORDINATE_SCALE = 1_000_000
+
+
+class Coordinate(TypeDecorator):
+    # Degrees stored as a scaled integer (microdegrees, ~0.1 m), returned as float
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(round(float(value) * COORDINATE_SCALE))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return value / COORDINATE_SCALE
+
 
 #  Users
 class Users(Base):
@@ -16,6 +35,8 @@ class Users(Base):
     is_valid = Column(Boolean, default=False)
     user_type = Column(Integer, ForeignKey("user_type.id"), default=1)
     create_date = Column(TIMESTAMP, default=datetime.datetime.now)
+    # Copied into every access token; bumping it revokes all tokens issued before (see token_cache)
+    token_generation = Column(Integer, nullable=False, default=0, server_default='0')
 
 
 class Usertype(Base):
@@ -40,11 +61,30 @@ class EmailConfirm(Base):
     unique = Column(String, unique=True)
     is_used = Column(Boolean, default=False)
     create_date = Column(TIMESTAMP)
-    expire_date = Column(TIMESTAMP)
+    expire_date = Column(TIMESTAMP, index=True)
+
+
+class EmailOutbox(Base):
+    __tablename__ = 'email_outbox'
+    __table_args__ = (Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt'),)
+    id = Column(Integer, primary_key=True, index=True)
+    sender = Column(String)
+    recipient = Column(String)
+    subject = Column(String)
+    body_text = Column(String)
+    body_html = Column(String)
+    status = Column(String, default='pending')
+    attempts = Column(Integer, default=0)
+    next_attempt = Column(TIMESTAMP, default=datetime.datetime.now)
+    created = Column(TIMESTAMP, default=datetime.datetime.now)
+    sent_date = Column(TIMESTAMP)
+    last_error = Column(String)
 
 
 class UserNotifications(Base):
     __tablename__ = 'user_notifications'
+    __table_args__ = (Index('ix_user_notifications_user_new_date', 'user_id', 'is_new', 'notification_date'),
+                      Index('ix_user_notifications_user_date_id', 'user_id', 'notification_date', 'id'))
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     is_visible = Column(Boolean, default=True)
@@ -54,8 +94,16 @@ class UserNotifications(Base):
     notification_date = Column(TIMESTAMP)
 
 
+class UserNotificationCounters(Base):
+    # Unread badge per user, kept in step with user_notifications by the notifications module
+    __tablename__ = 'user_notification_counters'
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    unread = Column(Integer, nullable=False, default=0)
+
+
 class EventLogger(Base):
     __tablename__ = 'event_logs'
+    __table_args__ = (Index('ix_event_logs_user_type_date', 'user_id', 'event_type', 'event_date'),)
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     event_type = Column(Integer, ForeignKey("events.id"))
@@ -91,8 +139,8 @@ class Games(Base):
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
     game_name = Column(String)
-    game_lobby_lat = Column(String)
-    game_lobby_lon = Column(String)
+    game_lobby_lat = Column(Coordinate)
+    game_lobby_lon = Column(Coordinate)
     start_date = Column(TIMESTAMP)
     auto_start = Column(Boolean, default=False)
     warmup_duration = Column(Integer)
@@ -128,11 +176,16 @@ class Teams(Base):
 
 
 class TeamSlots(Base):
+    # game_id repeats teams.game_id so the database itself allows a player only one slot per game
     __tablename__ = 'team_slots'
+    __table_args__ = (Index('ux_team_slots_game_user', 'game_id', 'user_id', unique=True,
+                            postgresql_where=text('user_id IS NOT NULL'),
+                            sqlite_where=text('user_id IS NOT NULL')),)
     id = Column(Integer, primary_key=True, index=True)
     slot_type = Column(Integer, ForeignKey("slot_type.id"))
     role = Column(Integer, ForeignKey("roles.id"))
     team_id = Column(Integer, ForeignKey("teams.id"))
+    game_id = Column(Integer, ForeignKey("games.id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"))
 
 
@@ -217,12 +270,13 @@ class MapLayer3(Base):
 
 class MapUsers(Base):
     __tablename__ = 'map_users'
+    __table_args__ = (UniqueConstraint('game_id', 'user_id'),)
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     game_id = Column(Integer, ForeignKey("games.id"))
-    latitude = Column(String)
-    longitude = Column(String)
-    last_update = Column(TIMESTAMP)
+    latitude = Column(Coordinate)
+    longitude = Column(Coordinate)
+    last_update = Column(TIMESTAMP, index=True)
     layer_0_zone = Column(Integer, ForeignKey("map_layer_0.id"))
     layer_1_zone = Column(Integer, ForeignKey("map_layer_1.id"))
     layer_2_zone = Column(Integer, ForeignKey("map_layer_2.id"))
@@ -230,16 +284,54 @@ class MapUsers(Base):
 
 
 class InGameLocationEvents(Base):
+    # Append-only, LIST-partitioned by game on PostgreSQL (see game_engine.location_store).
+    # The partition key has to be part of the primary key; id is filled from a sequence.
     __tablename__ = 'ingame_location_events'
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index('ix_ingame_location_events_game_tick', 'game_id', 'tick_id'),
+                      Index('ix_ingame_location_events_timestamp', 'timestamp'),
+                      {'postgresql_partition_by': 'LIST (game_id)'})
+    id = Column(BigInteger, primary_key=True, nullable=True, server_default=FetchedValue())
     user_id = Column(Integer, ForeignKey("users.id"))
-    game_id = Column(Integer, ForeignKey("games.id"))
-    latitude = Column(String)
-    longitude = Column(String)
+    game_id = Column(Integer, ForeignKey("games.id"), primary_key=True)
+    latitude = Column(Coordinate)
+    longitude = Column(Coordinate)
     timestamp = Column(TIMESTAMP)
     tick_id = Column(Integer)
 
 
+# Partitioned tables cannot use identity columns, so the id default comes from a plain sequence
+event.listen(InGameLocationEvents.__table__, 'after_create',
+             DDL("CREATE SEQUENCE IF NOT EXISTS ingame_location_events_id_seq "
+                 "OWNED BY ingame_location_events.id; "
+                 "ALTER TABLE ingame_location_events "
+                 "ALTER COLUMN id SET DEFAULT nextval('ingame_location_events_id_seq'); "
+                 "CREATE TABLE IF NOT EXISTS ingame_location_events_default "
+                 "PARTITION OF ingame_location_events DEFAULT").execute_if(dialect='postgresql'))
+
+
+class GameTicks(Base):
+    # Last tick id handed out per game; every worker allocates from this row (see game_engine.location_store)
+    __tablename__ = 'game_ticks'
+    game_id = Column(Integer, ForeignKey("games.id"), primary_key=True)
+    tick_id = Column(Integer, nullable=False, default=0)
+
+
+class PlayerTrajectories(Base):
+    # Archived location history of one player in one game, encoded by game_engine.trajectory
+    __tablename__ = 'player_trajectories'
+    __table_args__ = (UniqueConstraint('game_id', 'user_id'),)
+    id = Column(Integer, primary_key=True, index=True)
+    game_id = Column(Integer, ForeignKey("games.id"))
+    user_id = Column(Integer, ForeignKey("users.id"))
+    raw_points = Column(Integer)
+    points = Column(Integer)
+    tolerance = Column(Float)
+    first_tick = Column(Integer)
+    last_tick = Column(Integer)
+    data = Column(LargeBinary)
+    created = Column(TIMESTAMP, default=datetime.datetime.now)
+
+
 #  APP
 class AppEventsLogger(Base):
     __tablename__ = 'app_events'
@@ -0,0 +1,89 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import insert, literal, select, true, tuple_, update
+
+from database import dialect_insert
+from models import Teams, TeamSlots, UserNotificationCounters, UserNotifications, Users
+
+NOTIFICATION_COLUMNS = ['user_id', 'is_visible', 'is_new', 'category', 'notification_body', 'notification_date']
+
+
+def _notify(db, recipients, category, body, date_time=None):
+    # recipients is a SELECT of user ids; rows and counters are written with one INSERT ... SELECT each
+    recipients = recipients.subquery()
+    date_time = date_time or datetime.now()
+    created = db.execute(insert(UserNotifications).from_select(
+        NOTIFICATION_COLUMNS,
+        select(recipients.c.user_id, literal(True), literal(True), literal(category), literal(body),
+               literal(date_time, UserNotifications.notification_date.type)))).rowcount
+    counters = dialect_insert(db, UserNotificationCounters)
+    counters = counters.from_select(['user_id', 'unread'],
+                                    select(recipients.c.user_id, literal(1)).where(true()))
+    db.execute(counters.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={'unread': UserNotificationCounters.unread + counters.excluded.unread}))
+    return created
+
+
+def notify_users(db, user_ids, category, body, date_time=None):
+    return _notify(db, select(Users.id.label('user_id')).where(Users.id.in_(list(user_ids))),
+                   category, body, date_time)
+
+
+def notify_game(db, game_id, category, body, date_time=None):
+    players = select(TeamSlots.user_id.label('user_id')). \
+        join(Teams, Teams.id == TeamSlots.team_id). \
+        where(Teams.game_id == game_id, TeamSlots.user_id.is_not(None)).distinct()
+    return _notify(db, players, category, body, date_time)
+
+
+def unread_count(db, user_id):
+    # Primary key lookup on the counter row; no COUNT over user_notifications
+    return db.execute(select(UserNotificationCounters.unread)
+                      .where(UserNotificationCounters.user_id == user_id)).scalar() or 0
+
+
+def mark_read(db, user_id, ids=None):
+    statement = update(UserNotifications). \
+        where(UserNotifications.user_id == user_id,
+              UserNotifications.is_new == true(),
+              UserNotifications.is_visible == true())
+    if ids is not None:
+        statement = statement.where(UserNotifications.id.in_(ids))
+    # rowcount only covers rows this statement flipped, so concurrent calls cannot decrement twice
+    marked = db.execute(statement.values(is_new=False).execution_options(synchronize_session=False)).rowcount
+    if marked:
+        db.execute(update(UserNotificationCounters)
+                   .where(UserNotificationCounters.user_id == user_id)
+                   .values(unread=UserNotificationCounters.unread - marked))
+    return marked
+
+
+def encode_cursor(notification_date, notification_id):
+    raw = f"{notification_date.isoformat()}|{notification_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    notification_date, notification_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+    return datetime.fromisoformat(notification_date), int(notification_id)
+
+
+def notification_page(db, user_id, limit, cursor=None, unread_only=False):
+    # Keyset pagination on (notification_date, id): every page is an index range scan, however deep
+    query = select(UserNotifications.id,
+                   UserNotifications.category,
+                   UserNotifications.notification_body,
+                   UserNotifications.notification_date,
+                   UserNotifications.is_new). \
+        where(UserNotifications.user_id == user_id, UserNotifications.is_visible == true())
+    if unread_only:
+        query = query.where(UserNotifications.is_new == true())
+    if cursor is not None:
+        query = query.where(tuple_(UserNotifications.notification_date, UserNotifications.id) < decode_cursor(cursor))
+    rows = db.execute(query.order_by(UserNotifications.notification_date.desc(), UserNotifications.id.desc())
+                      .limit(limit + 1)).all()
+    next_cursor = encode_cursor(rows[limit - 1].notification_date, rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from config import BCRYPT_ROUNDS, PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT, REHASH_ON_LOGIN
+
+# min/max pinned to the configured cost so needs_update() flags hashes made with any other cost
+bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto',
+                              bcrypt__default_rounds=BCRYPT_ROUNDS,
+                              bcrypt__min_rounds=BCRYPT_ROUNDS,
+                              bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+class PasswordPool:
+    def __init__(self, workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.capacity = workers + queue_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._stats = {'depth': 0, 'max_depth': 0, 'completed': 0, 'rejected': 0,
+                       'wait_seconds': 0.0, 'work_seconds': 0.0}
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise PasswordPoolBusy()
+        with self._lock:
+            self._stats['depth'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], self._stats['depth'])
+        return self._executor.submit(self._timed, fn, time.perf_counter(), *args)
+
+    def _timed(self, fn, queued_at, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                self._stats['depth'] -= 1
+                self._stats['completed'] += 1
+                self._stats['wait_seconds'] += started - queued_at
+                self._stats['work_seconds'] += finished - started
+            self._slots.release()
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def run_sync(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['capacity'] = self.capacity
+        return stats
+
+
+password_pool = PasswordPool()
+
+
+def _verify(password, hashed_password):
+    if REHASH_ON_LOGIN:
+        return bcrypt_context.verify_and_update(password, hashed_password)
+    return bcrypt_context.verify(password, hashed_password), None
+
+
+async def verify_password(password: str, hashed_password: str):
+    # Returns (valid, new_hash); new_hash is set when the stored hash uses an outdated cost
+    return await password_pool.run(_verify, password, hashed_password)
+
+
+async def hash_password(password: str):
+    return await password_pool.run(bcrypt_context.hash, password)
+
+
+def hash_password_sync(password: str):
+    return password_pool.run_sync(bcrypt_context.hash, password)
@@ -0,0 +1,134 @@
+import threading
+import time
+import uuid
+from collections import deque
+
+import config
+
+SWEEP_EVERY = 1000
+MAX_WINDOW = max(config.LOGIN_FAILURE_WINDOW, config.REGISTRATION_WINDOW, config.EMAIL_RESEND_WINDOW)
+
+
+class MemoryBackend:
+    # Per-process sliding window log; pass a fake clock to drive it in tests
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _window(self, key, window, now):
+        hits = self._hits.get(key)
+        if hits is None:
+            return None
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        if not hits:
+            del self._hits[key]
+            return None
+        return hits
+
+    def peek(self, key, limit, window):
+        now = self.clock()
+        with self._lock:
+            hits = self._window(key, window, now)
+            if hits is None or len(hits) < limit:
+                return True, 0.0
+            return False, hits[0] + window - now
+
+    def hit(self, key, limit, window):
+        now = self.clock()
+        with self._lock:
+            hits = self._window(key, window, now)
+            if hits is None:
+                hits = self._hits[key] = deque()
+            if len(hits) >= limit:
+                return False, hits[0] + window - now
+            hits.append(now)
+            self._writes += 1
+            if self._writes % SWEEP_EVERY == 0:
+                self._sweep(now)
+            return True, 0.0
+
+    def _sweep(self, now):
+        # Windows are not known per key here, so drop keys idle for longer than the widest one
+        for key in [key for key, hits in self._hits.items() if not hits or hits[-1] <= now - MAX_WINDOW]:
+            del self._hits[key]
+
+    def reset(self, key):
+        with self._lock:
+            self._hits.pop(key, None)
+
+
+# Trim, check and record run as one script, so concurrent workers cannot all pass the same last slot
+HIT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return {0, redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')[2]}
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], math.floor(tonumber(ARGV[2])) + 1)
+return {1, ARGV[1]}
+"""
+
+
+class RedisBackend:
+    # Shared sliding window (one sorted set per key) for deployments with several workers
+    def __init__(self, url=config.REDIS_URL):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._hit = self._redis.register_script(HIT_SCRIPT)
+
+    def peek(self, key, limit, window):
+        now = time.time()
+        pipe = self._redis.pipeline()
+        pipe.zremrangebyscore(key, 0, now - window)
+        pipe.zrange(key, 0, 0, withscores=True)
+        pipe.zcard(key)
+        _, oldest, count = pipe.execute()
+        if count < limit:
+            return True, 0.0
+        return False, oldest[0][1] + window - now
+
+    def hit(self, key, limit, window):
+        now = time.time()
+        allowed, oldest = self._hit(keys=[key], args=[now, window, limit, f"{now}:{uuid.uuid4().hex}"])
+        if not allowed:
+            return False, float(oldest) + window - now
+        return True, 0.0
+
+    def reset(self, key):
+        self._redis.delete(key)
+
+
+def create_backend(name=config.RATE_LIMIT_BACKEND):
+    if name == 'redis':
+        return RedisBackend()
+    return MemoryBackend()
+
+
+class RateLimiter:
+    def __init__(self, name, limit, window, backend):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.backend = backend
+
+    def _key(self, identity):
+        return f"ratelimit:{self.name}:{identity}"
+
+    def peek(self, identity):
+        return self.backend.peek(self._key(identity), self.limit, self.window)
+
+    def hit(self, identity):
+        return self.backend.hit(self._key(identity), self.limit, self.window)
+
+    def reset(self, identity):
+        self.backend.reset(self._key(identity))
+
+
+backend = create_backend()
+login_failures_user = RateLimiter('login_user', config.LOGIN_FAILURES_PER_USER, config.LOGIN_FAILURE_WINDOW, backend)
+login_failures_ip = RateLimiter('login_ip', config.LOGIN_FAILURES_PER_IP, config.LOGIN_FAILURE_WINDOW, backend)
+registrations_ip = RateLimiter('register_ip', config.REGISTRATIONS_PER_IP, config.REGISTRATION_WINDOW, backend)
+email_resends_user = RateLimiter('email_resend', config.EMAIL_RESENDS_PER_USER, config.EMAIL_RESEND_WINDOW, backend)
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from config import REFERENCE_CACHE_TTL
+from database import on_commit
+from models import Usertype, Categories, Events, GameStatus, SlotType, Roles, ObjectTypes, ShapeTypes, \
+    MapObjects, Icons
+
+REFERENCE_MODELS = {'user_types': Usertype,
+                    'categories': Categories,
+                    'events': Events,
+                    'game_status': GameStatus,
+                    'slot_types': SlotType,
+                    'roles': Roles,
+                    'object_types': ObjectTypes,
+                    'shape_types': ShapeTypes,
+                    'map_objects': MapObjects,
+                    'icons': Icons}
+
+
+class ReferenceSnapshot:
+    __slots__ = ('version', 'catalog', 'body', 'etag', 'loaded')
+
+    def __init__(self, version, catalog):
+        self.version = version
+        self.catalog = catalog
+        # The ETag depends on content only, so every worker hands out the same one
+        self.body = json.dumps(catalog, separators=(',', ':'), default=str).encode()
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+        self.loaded = time.monotonic()
+
+
+class ReferenceCache:
+    # Lookup tables loaded in one pass; the TTL covers changes made by other processes
+    def __init__(self, ttl=REFERENCE_CACHE_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self, db):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.loaded < self.ttl:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or time.monotonic() - snapshot.loaded >= self.ttl:
+                snapshot = self._snapshot = self._load(db)
+        return snapshot
+
+    def _load(self, db):
+        catalog = {}
+        for name, model in REFERENCE_MODELS.items():
+            columns = [column.key for column in model.__table__.columns]
+            rows = db.query(*[getattr(model, column) for column in columns]).order_by(model.id).all()
+            catalog[name] = [dict(zip(columns, row)) for row in rows]
+        return ReferenceSnapshot(self.version, catalog)
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._snapshot = None
+
+    def mapping(self, db, name, key, value):
+        return {row[key]: row[value] for row in self.get(db).catalog[name]}
+
+
+reference_cache = ReferenceCache()
+
+
+def _reference_changed(mapper, connection, target):
+    on_commit(object_session(target), reference_cache.invalidate)
+
+
+for _model in REFERENCE_MODELS.values():
+    event.listen(_model, 'after_insert', _reference_changed)
+    event.listen(_model, 'after_update', _reference_changed)
+    event.listen(_model, 'after_delete', _reference_changed)
@@ -1,27 +1,27 @@
 from typing import Annotated
 from datetime import timedelta
-import requests
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 from pydantic import BaseModel, Field
 from pydantic.networks import EmailStr
 from jose import jwt, JWTError
-from requests.exceptions import SSLError, JSONDecodeError
-from sqlalchemy import func
+from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
 from starlette import status
 from datetime import datetime
 import random
 import string
 
-from starlette.responses import HTMLResponse
-from urllib3.exceptions import MaxRetryError
-from database import SessionLocal
-from models import Users, EventLogger, UserNotifications, EmailConfirm
+from client_ip import get_client_ip
+from rate_limit import login_failures_user, login_failures_ip, registrations_ip, email_resends_user
+from token_cache import token_cache, token_revocations
+from passwords import verify_password, hash_password, hash_password_sync, PasswordPoolBusy
+from database import db_dependency, async_db_dependency
+from models import Users, EmailConfirm
+from notifications import notify_users
+from app_tasks.log_writer import log_event
 from sendmail import send_email_verification
-from html_response import email_confirmed
+from html_response import static_page
 
 router = APIRouter(prefix='/account', tags=['Authentication'])
 
@@ -35,17 +35,6 @@ class Token(BaseModel):
     token_type: str
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-db_dependency = Annotated[Session, Depends(get_db)]
-
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='account/login')
 
 
@@ -75,49 +64,69 @@ class UpdateUserPassword(BaseModel):
         }
 
 
-def authenticate_user(email: str, password: str, db):
-    user = db.query(Users).filter(Users.email == email).first()
+async def authenticate_user(email: str, password: str, db):
+    user = (await db.execute(select(Users).where(Users.email == email))).scalars().first()
     if not user:
         return False
-    if not bcrypt_context.verify(password, user.hashed_password):
-        event_log = EventLogger(event_type=5,
-                                user_id=user.id,
-                                event_body=f"Login failed. Account: {user.email}, user_id: {user.id}. Wrong password.")
-        db.add(event_log)
-        db.commit()
+    valid, new_hash = await verify_password(password, user.hashed_password)
+    if not valid:
+        log_event(event_type=5,
+                  user_id=user.id,
+                  event_body=f"Login failed. Account: {user.email}, user_id: {user.id}. Wrong password.")
         return False
+    if new_hash:
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
 
-def create_access_token(username: str, user_id: int, expires_delta: timedelta):
-    encode = {'sub': username, 'id': user_id}
+def server_busy():
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Server busy, try again',
+                         headers={'Retry-After': '1'})
+
+
+def create_access_token(username: str, user_id: int, expires_delta: timedelta, generation: int = 0):
+    encode = {'sub': username, 'id': user_id, 'gen': generation}
     expires = datetime.now() + expires_delta
     encode.update({'exp': expires})
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
+async def verify_token(token: str):
+    # Only tokens older than a known generation are rejected; a newer one means this process is behind
+    cached = token_cache.get(token)
+    if cached is not None:
+        user, generation = cached
+        if generation >= token_revocations.generation(user['id']):
+            return user
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized')
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get('sub')
-        user_id: int = payload.get('id')
-        if email is None or user_id is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized')
-        return {'email': email, 'id': user_id}
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized')
+    email: str = payload.get('sub')
+    user_id: int = payload.get('id')
+    generation: int = payload.get('gen', 0)
+    if email is None or user_id is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized')
+    current = await token_revocations.current(user_id)
+    if current is None or generation < current:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized')
+    user = {'email': email, 'id': user_id}
+    token_cache.put(token, (user, generation), payload.get('exp', 0))
+    return user
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
+    return await verify_token(token)
 
 
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 
-def check_user_logs(db, user_id, event_type, time_delta):
-    start_time = datetime.now() - timedelta(minutes=time_delta)
-    query = db.query(func.count()). \
-        filter(EventLogger.user_id == user_id). \
-        filter(EventLogger.event_type == event_type). \
-        filter(EventLogger.event_date >= start_time).scalar()
-    return query
+def too_many_requests(retry_after: float):
+    return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='Too many attempts, try again later',
+                         headers={'Retry-After': str(max(int(retry_after + 0.999), 1))})
 
 
 def email_activation(db: db_dependency, user_id, date_time):
@@ -131,13 +140,12 @@ def email_activation(db: db_dependency, user_id, date_time):
     db.commit()
 
 
-def get_user_ip():
-    response = requests.get('https://api.ipify.org?format=json').json()
-    return response["ip"]
-
-
 @router.post("/register", status_code=status.HTTP_201_CREATED)
-def register_user(db: db_dependency, create_user_request: CreateUserRequest):
+def register_user(db: db_dependency, create_user_request: CreateUserRequest, request: Request):
+    client_host = get_client_ip(request)
+    allowed, retry_after = registrations_ip.hit(client_host)
+    if not allowed:
+        raise too_many_requests(retry_after)
     try:
         existing_email = db.query(Users).filter(Users.email == create_user_request.email).first()
 
@@ -146,104 +154,125 @@ def register_user(db: db_dependency, create_user_request: CreateUserRequest):
 
         date_time = datetime.now()
         create_user_model = Users(email=create_user_request.email,
-                                  hashed_password=bcrypt_context.hash(create_user_request.password),
+                                  hashed_password=hash_password_sync(create_user_request.password),
                                   create_date=date_time)
         db.add(create_user_model)
         db.flush()
         new_user_id = create_user_model.id
         email_activation(db, create_user_model.id, date_time)
-        event_log = EventLogger(event_type=1,
-                                user_id=new_user_id,
-                                event_body=f"New account created. Account: {create_user_request.email}, "
-                                           f"user_id: {new_user_id}",
-                                event_date=date_time,
-                                client_host=get_user_ip()
-                                )
-        db.add(event_log)
-
-        notification_log = UserNotifications(user_id=new_user_id,
-                                             is_visible=True,
-                                             is_new=True,
-                                             category=1,
-                                             notification_body=f"Congratulations! Your account has been created.",
-                                             notification_date=date_time
-                                             )
-        db.add(notification_log)
-        db.flush()
+
+        notify_users(db, [new_user_id], 1, "Congratulations! Your account has been created.", date_time)
         send_email_verification(new_user_id, db)
+        log_event(event_type=1,
+                  user_id=new_user_id,
+                  event_body=f"New account created. Account: {create_user_request.email}, "
+                             f"user_id: {new_user_id}",
+                  event_date=date_time,
+                  client_host=client_host)
 
         return {"message": "Account created"}
 
     except SQLAlchemyError:
         db.rollback()
         raise HTTPException(status_code=500, detail="Database Error")
-    except JSONDecodeError:
+    except PasswordPoolBusy:
         db.rollback()
-        raise HTTPException(status_code=500, detail="Error processing data")
-    except (SSLError, MaxRetryError):
-        db.rollback()
-        raise HTTPException(status_code=500, detail="ipify.org offline")
+        raise server_busy()
     finally:
         db.commit()
         db.close()
 
 
 @router.post("/login", response_model=Token)
-async def login_for_access_token(form: Annotated[OAuth2PasswordRequestForm, Depends()], db: db_dependency):
-    user = authenticate_user(form.username, form.password, db)
+async def login_for_access_token(form: Annotated[OAuth2PasswordRequestForm, Depends()], db: async_db_dependency,
+                                 request: Request):
+    client_host = get_client_ip(request)
+    username = form.username.lower()
+    # Attempts on an account are counted before the password is checked, so parallel guesses cannot all slip
+    # through one free slot; a successful login clears the account's counter again. Many players can share
+    # one address (a proxy, a venue), so the address only counts failures.
+    allowed, retry_after = login_failures_ip.peek(client_host)
+    if not allowed:
+        raise too_many_requests(retry_after)
+    allowed, retry_after = login_failures_user.hit(username)
+    if not allowed:
+        raise too_many_requests(retry_after)
+    try:
+        user = await authenticate_user(form.username, form.password, db)
+    except PasswordPoolBusy:
+        raise server_busy()
     if not user:
+        login_failures_ip.hit(client_host)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Unauthorized')
-    account_status = db.query(Users.is_active).filter(Users.email == form.username).scalar()
+    login_failures_user.reset(username)
+    account_status = user.is_active
     if account_status == 0:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Account disabled')
-    token = create_access_token(user.email, user.id, timedelta(minutes=TOKEN_EXPIRE))
-    event_log = EventLogger(event_type=4,
-                            user_id=user.id,
-                            event_body=f"Login successful. Account: {user.email}, user_id: {user.id}",
-                            client_host=get_user_ip())
-    db.add(event_log)
-    db.commit()
+    token = create_access_token(user.email, user.id, timedelta(minutes=TOKEN_EXPIRE), user.token_generation)
+    log_event(event_type=4,
+              user_id=user.id,
+              event_body=f"Login successful. Account: {user.email}, user_id: {user.id}",
+              client_host=client_host)
     return {'access_token': token, 'token_type': 'bearer'}
 
 
 @router.get("/confirm_email/{unique}")
-async def confirm_user_email(db: db_dependency, unique):
-    email_unique = db.query(EmailConfirm).filter(EmailConfirm.unique == unique).order_by(EmailConfirm.id.desc()).first()
+async def confirm_user_email(db: async_db_dependency, unique, request: Request):
+    email_unique = (await db.execute(select(EmailConfirm).where(EmailConfirm.unique == unique))).scalars().first()
     if not email_unique or email_unique.expire_date < datetime.now():
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not found')
     if email_unique.is_used == 1:
         raise HTTPException(status_code=status.HTTP_410_GONE, detail='Gone')
-    user = db.query(Users).filter(Users.id == email_unique.user_id).first()
+    user = await db.get(Users, email_unique.user_id)
     user.is_valid = True
     email_unique.is_used = True
-    event_log = EventLogger(event_type=15,
-                            user_id=user.id,
-                            event_body=f"Email confirmed. Account: {user.email}, "
-                                       f"user_id: {user.id}"
-                            )
-    db.add(event_log)
-    db.commit()
-    db.close()
-    return HTMLResponse(content=email_confirmed())
+    await db.commit()
+    log_event(event_type=15,
+              user_id=user.id,
+              event_body=f"Email confirmed. Account: {user.email}, "
+                         f"user_id: {user.id}")
+    return static_page(request, "confirm_email_thankyou.html")
 
 
-@router.put("/update_password", status_code=status.HTTP_204_NO_CONTENT)
-async def change_password(user: user_dependency, db: db_dependency, user_verification: UpdateUserPassword):
+@router.post("/resend_confirmation", status_code=status.HTTP_202_ACCEPTED)
+def resend_confirmation(user: user_dependency, db: db_dependency):
     if user is None:
         raise HTTPException(status_code=401, detail='Unauthorized')
+    allowed, retry_after = email_resends_user.hit(user.get('id'))
+    if not allowed:
+        raise too_many_requests(retry_after)
     user_model = db.query(Users).filter(Users.id == user.get('id')).first()
+    if user_model is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    if user_model.is_valid:
+        raise HTTPException(status_code=400, detail='E-mail already confirmed')
+    email_activation(db, user_model.id, datetime.now())
+    send_email_verification(user_model.id, db)
+    db.commit()
+    return {"message": "Confirmation e-mail sent"}
 
-    if not bcrypt_context.verify(user_verification.password, user_model.hashed_password):
-        raise HTTPException(status_code=400, detail='Current password is wrong')
 
-    if user_verification.password == user_verification.new_password:
-        raise HTTPException(status_code=400, detail='New password must be different from the current password')
+@router.put("/update_password", status_code=status.HTTP_204_NO_CONTENT)
+async def change_password(user: user_dependency, db: async_db_dependency, user_verification: UpdateUserPassword):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    user_model = await db.get(Users, user.get('id'))
 
-    user_model.hashed_password = bcrypt_context.hash(user_verification.new_password)
-    event_log = EventLogger(event_type=6,
-                            user_id=user.get('id'),
-                            details=f"Password changed for username: {user.get('username')}"
-                            )
-    db.add(user_model)
-    db.add(event_log)
-    db.commit()
+    try:
+        valid, _ = await verify_password(user_verification.password, user_model.hashed_password)
+        if not valid:
+            raise HTTPException(status_code=400, detail='Current password is wrong')
+
+        if user_verification.password == user_verification.new_password:
+            raise HTTPException(status_code=400, detail='New password must be different from the current password')
+
+        user_model.hashed_password = await hash_password(user_verification.new_password)
+    except PasswordPoolBusy:
+        raise server_busy()
+    user_model.token_generation = Users.token_generation + 1
+    await db.commit()
+    await db.refresh(user_model, ['token_generation'])
+    token_revocations.observe(user_model.id, user_model.token_generation)
+    log_event(event_type=6,
+              user_id=user.get('id'),
+              event_body=f"Password changed for username: {user.get('email')}")
@@ -1,7 +1,450 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import json
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, Field, root_validator
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
 from starlette import status
-from .auth import user_dependency, db_dependency
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from .auth import user_dependency, verify_token
+from config import ACTIVE_GAME_STATUSES
+from database import SessionLocal, db_dependency
+from game_engine.live import live_hub
+from game_engine.zone_index import parse_shape
+from game_engine.location_store import ensure_partition, replay_ticks
+from game_engine.slots import claim_slot, game_member, join_game, release_slot
+from game_engine.tick_engine import find_tick_engine, get_tick_engine
+from game_engine.trajectory import live_trajectory, stored_trajectory, to_points
+from models import Games, Teams, TeamSlots, Users, MapLayer0, MapLayer1, MapLayer2, MapLayer3
+from reference_data import reference_cache
 
 
 router = APIRouter(prefix='/game', tags=['Game'])
 
+
+class PositionReport(BaseModel):
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+
+    class Config:
+        schema_extra = {
+            'example': {
+                'latitude': 50.5,
+                'longitude': 30.5
+            }
+        }
+
+
+class LobbyLocation(BaseModel):
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+
+
+class ZoneSettings(BaseModel):
+    shape_name: str
+    shape_type: str
+    shape: str
+    color: Optional[str] = None
+
+
+class Layer0Zone(ZoneSettings):
+    expires: Optional[int] = None
+    expires_order: Optional[int] = None
+    kill_timer: Optional[int] = None
+
+
+class Layer1Zone(ZoneSettings):
+    danger: bool = False
+    kill_timer: Optional[int] = None
+
+
+class Layer2Zone(ZoneSettings):
+    time_delay: int = 5
+    release_players: int = 1
+
+
+class Layer3Zone(ZoneSettings):
+    name_visible: bool = True
+    object_type: Optional[int] = None
+    object_icon: Optional[int] = None
+
+
+class MapSettings(BaseModel):
+    layer_0: List[Layer0Zone] = []
+    layer_1: List[Layer1Zone] = []
+    layer_2: List[Layer2Zone] = []
+    layer_3: List[Layer3Zone] = []
+
+
+class SlotSettings(BaseModel):
+    slot_type: int
+    slot_role: int
+    user_id: Optional[int] = None
+
+
+class TeamSettings(BaseModel):
+    team_name: str
+    team_color: Optional[str] = None
+    team_slots: int = Field(ge=1)
+    slots: List[SlotSettings] = []
+
+    @root_validator(skip_on_failure=True)
+    def check_slots(cls, values):
+        if len(values['slots']) > values['team_slots']:
+            raise ValueError('More slots than team_slots')
+        return values
+
+
+class TeamsSettings(BaseModel):
+    max_players: int = Field(ge=1)
+    max_teams: int = Field(ge=1)
+    teams: List[TeamSettings]
+
+    @root_validator(skip_on_failure=True)
+    def check_capacity(cls, values):
+        if len(values['teams']) > values['max_teams']:
+            raise ValueError('More teams than max_teams')
+        if sum(team.team_slots for team in values['teams']) > values['max_players']:
+            raise ValueError('Team slots exceed max_players')
+        return values
+
+
+class GameSettings(BaseModel):
+    game_name: str = Field(min_length=1)
+    game_lobby_location: LobbyLocation
+    start_date: datetime
+    auto_start: bool = False
+    warmup_duration: int = Field(alias='warpup_duration', ge=0)
+    game_duration: int = Field(ge=1)
+    offmap_timer: int = Field(ge=0)
+    map_settings: MapSettings = MapSettings()
+    teams: TeamsSettings
+
+    class Config:
+        allow_population_by_field_name = True
+
+
+class CreateGameRequest(BaseModel):
+    game_settings: GameSettings
+
+    class Config:
+        schema_extra = {
+            'example': {
+                'game_settings': {
+                    'game_name': 'Sunday game',
+                    'game_lobby_location': {'latitude': 50.5, 'longitude': 30.5},
+                    'start_date': '2023-06-25 10:00:00',
+                    'auto_start': False,
+                    'warpup_duration': 10,
+                    'game_duration': 120,
+                    'offmap_timer': 15,
+                    'map_settings': {
+                        'layer_0': [{'shape_name': 'Game area', 'shape_type': 'Polygon',
+                                     'shape': '[[50.4, 30.4],[50.6, 30.4],[50.6, 30.6],[50.4, 30.6]]',
+                                     'expires': 60, 'expires_order': 1, 'kill_timer': 20, 'color': '#ff0000'}],
+                        'layer_1': [{'shape_name': 'Danger', 'shape_type': 'Circle',
+                                     'shape': '[50.5, 30.5], {radius: 200}', 'color': '#000000', 'danger': True}]
+                    },
+                    'teams': {
+                        'max_players': 8,
+                        'max_teams': 2,
+                        'teams': [{'team_name': 'Red', 'team_color': '#ff0000', 'team_slots': 4,
+                                   'slots': [{'slot_type': 1, 'slot_role': 1}]}]
+                    }
+                }
+            }
+        }
+
+
+def bulk_insert(db, model, rows):
+    # One multi-row INSERT ... RETURNING per table; ids come back in parameter order
+    if not rows:
+        return []
+    statement = insert(model).returning(model.id, sort_by_parameter_order=True)
+    return db.execute(statement, rows).scalars().all()
+
+
+def reference_ids(db, name, key='id'):
+    return {row[key]: row for row in reference_cache.get(db).catalog[name]}
+
+
+def zone_rows(db, game_id, layer, zones):
+    shape_types = {row['type'].lower(): row['id'] for row in reference_cache.get(db).catalog['shape_types']}
+    object_types = reference_ids(db, 'object_types')
+    icons = reference_ids(db, 'icons')
+    rows = []
+    for zone_id, zone in enumerate(zones, start=1):
+        shape_type = shape_types.get(zone.shape_type.lower())
+        if shape_type is None:
+            raise HTTPException(status_code=422, detail=f"Unknown shape type: {zone.shape_type}")
+        try:
+            parse_shape(zone.shape_type, zone.shape)
+        except (ValueError, TypeError, IndexError):
+            raise HTTPException(status_code=422, detail=f"Invalid shape for layer {layer} zone {zone_id}")
+        row = {'game_id': game_id,
+               'zone_id': zone_id,
+               'zone_name': zone.shape_name,
+               'shape_type': shape_type,
+               'zone_shape': zone.shape,
+               'color': zone.color}
+        if layer == 0:
+            row.update(expires=zone.expires, kill_timer=zone.kill_timer)
+        elif layer == 1:
+            row.update(danger=zone.danger, kill_timer=zone.kill_timer)
+        elif layer == 2:
+            row.update(time_delay=zone.time_delay, release_players=zone.release_players)
+        else:
+            if zone.object_type is not None and zone.object_type not in object_types:
+                raise HTTPException(status_code=422, detail=f"Unknown object type: {zone.object_type}")
+            if zone.object_icon is not None and zone.object_icon not in icons:
+                raise HTTPException(status_code=422, detail=f"Unknown icon: {zone.object_icon}")
+            row.update(map_object_type=object_types[zone.object_type]['type'] if zone.object_type else None,
+                       object_icon=zone.object_icon)
+        rows.append(row)
+    return rows
+
+
+@router.post("", status_code=status.HTTP_201_CREATED)
+def create_game(user: user_dependency, db: db_dependency, create_game_request: CreateGameRequest):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    settings = create_game_request.game_settings
+    slot_types = reference_ids(db, 'slot_types')
+    roles = reference_ids(db, 'roles')
+    for team in settings.teams.teams:
+        for slot in team.slots:
+            if slot.slot_type not in slot_types:
+                raise HTTPException(status_code=422, detail=f"Unknown slot type: {slot.slot_type}")
+            if slot.slot_role not in roles:
+                raise HTTPException(status_code=422, detail=f"Unknown role: {slot.slot_role}")
+    # A player holds at most one slot per game, and preassigned slots must name existing accounts
+    user_ids = [slot.user_id for team in settings.teams.teams for slot in team.slots if slot.user_id is not None]
+    if len(set(user_ids)) != len(user_ids):
+        raise HTTPException(status_code=400, detail='A user is assigned to more than one slot')
+    unknown = set(user_ids) - set(db.execute(select(Users.id).where(Users.id.in_(user_ids))).scalars())
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown user: {min(unknown)}")
+    try:
+        game_id = bulk_insert(db, Games, [{'owner_id': user.get('id'),
+                                           'game_name': settings.game_name,
+                                           'game_lobby_lat': settings.game_lobby_location.latitude,
+                                           'game_lobby_lon': settings.game_lobby_location.longitude,
+                                           'start_date': settings.start_date,
+                                           'auto_start': settings.auto_start,
+                                           'warmup_duration': settings.warmup_duration,
+                                           'game_duration': settings.game_duration,
+                                           'offmap_timer': settings.offmap_timer,
+                                           'players': settings.teams.max_players,
+                                           'teams': settings.teams.max_teams,
+                                           'created': datetime.now()}])[0]
+
+        team_ids = bulk_insert(db, Teams, [{'game_id': game_id,
+                                            'team_name': team.team_name,
+                                            'team_color': team.team_color,
+                                            'team_slots': team.team_slots} for team in settings.teams.teams])
+        slot_rows = [{'team_id': team_id,
+                      'game_id': game_id,
+                      'slot_type': slot.slot_type,
+                      'role': slot.slot_role,
+                      'user_id': slot.user_id}
+                     for team_id, team in zip(team_ids, settings.teams.teams) for slot in team.slots]
+        slot_ids = iter(bulk_insert(db, TeamSlots, slot_rows))
+
+        layers = {}
+        map_settings = settings.map_settings
+        for layer, (model, zones) in enumerate(((MapLayer0, map_settings.layer_0), (MapLayer1, map_settings.layer_1),
+                                                (MapLayer2, map_settings.layer_2), (MapLayer3, map_settings.layer_3))):
+            rows = zone_rows(db, game_id, layer, zones)
+            zone_ids = bulk_insert(db, model, rows)
+            layers[f"layer_{layer}"] = [{'id': zone_pk, **row} for zone_pk, row in zip(zone_ids, rows)]
+        ensure_partition(db, game_id)
+        db.commit()
+    except SQLAlchemyError:
+        db.rollback()
+        raise HTTPException(status_code=500, detail="Database Error")
+    except HTTPException:
+        db.rollback()
+        raise
+
+    return {'id': game_id,
+            **settings.dict(exclude={'map_settings', 'teams'}),
+            'teams': [{'id': team_id,
+                       'team_name': team.team_name,
+                       'team_color': team.team_color,
+                       'team_slots': team.team_slots,
+                       'slots': [{'id': next(slot_ids), **slot.dict()} for slot in team.slots]}
+                      for team_id, team in zip(team_ids, settings.teams.teams)],
+            'map_settings': layers}
+
+
+class JoinRequest(BaseModel):
+    team_id: Optional[int] = None
+
+
+@router.post("/{game_id}/join")
+def join_game_slot(user: user_dependency, db: db_dependency, game_id: int, join_request: JoinRequest = JoinRequest()):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    row = join_game(db, game_id, user.get('id'), join_request.team_id)
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='No free slot')
+    return {'slot_id': row.id, 'team_id': row.team_id}
+
+
+@router.post("/{game_id}/slots/{slot_id}/claim")
+def claim_game_slot(user: user_dependency, db: db_dependency, game_id: int, slot_id: int):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    row = claim_slot(db, game_id, user.get('id'), slot_id)
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Slot not available')
+    return {'slot_id': row.id, 'team_id': row.team_id}
+
+
+@router.delete("/{game_id}/slots/mine", status_code=status.HTTP_204_NO_CONTENT)
+def release_game_slot(user: user_dependency, db: db_dependency, game_id: int):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    if not release_slot(db, game_id, user.get('id')):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not found')
+    engine = find_tick_engine(game_id)
+    if engine is not None:
+        engine.state.release_slot(user.get('id'))
+
+
+@router.get("/catalog")
+def reference_catalog(db: db_dependency, request: Request):
+    snapshot = reference_cache.get(db)
+    headers = {'ETag': snapshot.etag, 'Cache-Control': 'no-cache', 'X-Catalog-Version': str(snapshot.version)}
+    if request.headers.get('if-none-match') == snapshot.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type='application/json', headers=headers)
+
+
+@router.post("/{game_id}/position", status_code=status.HTTP_202_ACCEPTED)
+def report_position(user: user_dependency, db: db_dependency, game_id: int, position: PositionReport):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    user_id = user.get('id')
+    engine = find_tick_engine(game_id)
+    # The running engine already knows its slot holders; anyone else is checked against the database
+    if engine is None or not engine.state.holds_slot(user_id):
+        game, slot = game_member(db, game_id, user_id)
+        if game is None:
+            raise HTTPException(status_code=404, detail='Not found')
+        if not game_running(game):
+            raise HTTPException(status_code=403, detail='Game is not running')
+        if slot is None:
+            raise HTTPException(status_code=403, detail='Forbidden')
+        engine = get_tick_engine(db, game_id)
+        engine.state.assign_slot(user_id, slot.id, slot.team_id, slot.role, slot.slot_type)
+    engine.report(user_id, position.latitude, position.longitude)
+    return {"tick_id": engine.tick_id + 1}
+
+
+def replay_stream(game_id, from_tick, to_tick):
+    db = SessionLocal()
+    try:
+        for tick_id, positions in replay_ticks(db, game_id, from_tick, to_tick):
+            yield json.dumps({'tick_id': tick_id,
+                              'positions': [[user_id, latitude, longitude, timestamp.isoformat()]
+                                            for user_id, latitude, longitude, timestamp in positions]}) + '\n'
+    finally:
+        db.close()
+
+
+@router.get("/{game_id}/replay")
+def replay_game(user: user_dependency, db: db_dependency, game_id: int,
+                from_tick: int | None = None, to_tick: int | None = None):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    game, _ = game_viewer(db, game_id, user.get('id'))
+    # While the game runs a replay is a live position feed; only the owner may pull one
+    if game_running(game) and game.owner_id != user.get('id'):
+        raise HTTPException(status_code=403, detail='Game is running')
+    return StreamingResponse(replay_stream(game_id, from_tick, to_tick), media_type='application/x-ndjson')
+
+
+@router.get("/{game_id}/trajectory/{user_id}")
+def player_trajectory(user: user_dependency, db: db_dependency, game_id: int, user_id: int):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    game, slot = game_viewer(db, game_id, user.get('id'))
+    # Archived games are decoded from player_trajectories, running ones read from the event log
+    trajectory = stored_trajectory(db, game_id, user_id)
+    archived = trajectory is not None
+    if not archived:
+        # A running track is the player's current position: only the owner, the player and teammates see it
+        if game_running(game) and game.owner_id != user.get('id') and user_id != user.get('id'):
+            _, target = game_member(db, game_id, user_id)
+            if target is None or slot is None or target.team_id != slot.team_id:
+                raise HTTPException(status_code=403, detail='Forbidden')
+        trajectory = live_trajectory(db, game_id, user_id)
+    if trajectory is None:
+        raise HTTPException(status_code=404, detail='Not found')
+    return {'game_id': game_id,
+            'user_id': user_id,
+            'archived': archived,
+            'points': to_points(*trajectory)}
+
+
+@router.websocket("/{game_id}/live")
+async def live_game(websocket: WebSocket, game_id: int, token: str):
+    # Browsers cannot set headers on a WebSocket handshake, so the bearer token comes as a query parameter
+    try:
+        user = await verify_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not await run_in_threadpool(can_watch_game, game_id, user.get('id')):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    queue = live_hub.subscribe(game_id)
+    sender = asyncio.create_task(send_live_updates(websocket, game_id, queue))
+    try:
+        # Clients only listen; reading keeps disconnects from going unnoticed between ticks
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        # Wait for the sender to finish; a send that failed on the closed socket is expected here
+        await asyncio.gather(sender, return_exceptions=True)
+        live_hub.unsubscribe(game_id, queue)
+
+
+def game_running(game):
+    return (game.status_name or '').lower() in ACTIVE_GAME_STATUSES
+
+
+def game_viewer(db, game_id: int, user_id: int):
+    # Positions of a game are only shown to its slot holders and its owner
+    game, slot = game_member(db, game_id, user_id)
+    if game is None:
+        raise HTTPException(status_code=404, detail='Not found')
+    if slot is None and game.owner_id != user_id:
+        raise HTTPException(status_code=403, detail='Forbidden')
+    return game, slot
+
+
+def can_watch_game(game_id: int, user_id: int):
+    with SessionLocal() as db:
+        try:
+            game_viewer(db, game_id, user_id)
+        except HTTPException:
+            return False
+    return True
+
+
+async def send_live_updates(websocket: WebSocket, game_id: int, queue):
+    engine = find_tick_engine(game_id)
+    if engine is not None:
+        await websocket.send_text(json.dumps(engine.snapshot(), default=str))
+    while True:
+        await websocket.send_text(await queue.get())
@@ -0,0 +1,84 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from pydantic import BaseModel, Field
+from starlette import status
+
+from database import db_dependency
+from models import Games
+from notifications import mark_read, notification_page, notify_game, unread_count
+from .auth import user_dependency
+
+router = APIRouter(prefix='/notifications', tags=['Notifications'])
+
+
+class MarkReadRequest(BaseModel):
+    ids: Optional[List[int]] = Field(default=None, max_items=500)
+
+    class Config:
+        schema_extra = {
+            'example': {
+                'ids': [12, 15]
+            }
+        }
+
+
+class GameNotificationRequest(BaseModel):
+    category: int
+    notification_body: str = Field(min_length=1, max_length=1000)
+
+    class Config:
+        schema_extra = {
+            'example': {
+                'category': 2,
+                'notification_body': 'The game starts in 10 minutes'
+            }
+        }
+
+
+@router.get("")
+def read_notifications(user: user_dependency, db: db_dependency, cursor: Optional[str] = None,
+                       limit: int = Query(default=20, ge=1, le=100), unread_only: bool = False):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    try:
+        rows, next_cursor = notification_page(db, user.get('id'), limit, cursor, unread_only)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    return {'notifications': [{'id': row.id,
+                               'category': row.category,
+                               'notification_body': row.notification_body,
+                               'notification_date': row.notification_date,
+                               'is_new': row.is_new} for row in rows],
+            'next_cursor': next_cursor}
+
+
+@router.get("/unread_count")
+def read_unread_count(user: user_dependency, db: db_dependency):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    return {'unread': unread_count(db, user.get('id'))}
+
+
+@router.post("/mark_read")
+def mark_notifications_read(user: user_dependency, db: db_dependency, mark_read_request: MarkReadRequest):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    marked = mark_read(db, user.get('id'), mark_read_request.ids)
+    db.commit()
+    return {'marked': marked, 'unread': unread_count(db, user.get('id'))}
+
+
+@router.post("/game/{game_id}", status_code=status.HTTP_201_CREATED)
+def notify_game_players(user: user_dependency, db: db_dependency, game_id: int,
+                        notification_request: GameNotificationRequest):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    owner_id = db.query(Games.owner_id).filter(Games.id == game_id).scalar()
+    if owner_id is None:
+        raise HTTPException(status_code=404, detail='Not found')
+    if owner_id != user.get('id'):
+        raise HTTPException(status_code=403, detail='Forbidden')
+    sent = notify_game(db, game_id, notification_request.category, notification_request.notification_body)
+    db.commit()
+    return {'sent': sent}
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+from database import pool_metrics, get_async_engine
+from instrumentation import metrics
+from passwords import password_pool
+from token_cache import token_cache
+from app_tasks.log_writer import log_writer
+from app_tasks.runner import service_runner
+from game_engine.tick_engine import engine_metrics
+
+router = APIRouter(prefix='/service', tags=['Service'])
+
+
+@router.get("/status")
+def service_status(request: Request):
+    return {'startup': {'import_seconds': getattr(request.app.state, 'import_seconds', None),
+                        'boot_seconds': getattr(request.app.state, 'boot_seconds', None)},
+            'db_pool': pool_metrics(),
+            'async_db_pool': pool_metrics(get_async_engine().sync_engine),
+            'password_pool': password_pool.metrics(),
+            'token_cache': {'size': len(token_cache), 'hits': token_cache.hits, 'misses': token_cache.misses},
+            'log_writer': {'pending': log_writer.pending(), 'written': log_writer.written,
+                           'failed': log_writer.failed, 'blocked': log_writer.blocked,
+                           'spilled': log_writer.spilled, 'dropped': log_writer.dropped,
+                           'last_error': log_writer.last_error},
+            'services': service_runner.metrics(),
+            'games': engine_metrics()}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def service_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
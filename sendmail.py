@@ -1,65 +1,204 @@
+from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from fastapi import Depends
-from sqlalchemy.orm import Session
-from typing import Annotated
-from database import SessionLocal
-from models import EmailConfirm, Users
+from database import db_dependency, on_commit, SessionLocal
+from html_response import templates
+from instrumentation import external_call
+from models import EmailConfirm, EmailOutbox, Users
 import smtplib
+import threading
+import time
 
+from config import SMTP_HOST, SMTP_PORT, SMTP_LOGIN, SMTP_PASSWORD, SMTP_STARTTLS, SMTP_IDLE_TIMEOUT, \
+    MAIL_SENDER, API_URL, OUTBOX_POLL_INTERVAL, OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY, \
+    OUTBOX_CLAIM_TIMEOUT
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+api_url = API_URL
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
-
-login = "11d6f8dbafbd24"
-password = "38c92d7a8189f9"
-api_url = "http://127.0.0.1:8000"
+def queue_email(db, receiver_email, subject, text, html, sender_email=MAIL_SENDER):
+    # Stored in the caller's transaction; MailOutbox sends it once the transaction commits
+    message = EmailOutbox(sender=sender_email,
+                          recipient=receiver_email,
+                          subject=subject,
+                          body_text=text,
+                          body_html=html,
+                          status='pending',
+                          attempts=0,
+                          next_attempt=datetime.now())
+    db.add(message)
+    # Wake the sender as soon as the message is visible instead of waiting for the next poll
+    on_commit(db, mail_outbox.notify)
+    return message
 
 
 def send_email_verification(user_id, db: db_dependency):
     user = db.query(Users).filter(Users.id == user_id).first()
-    confirm = db.query(EmailConfirm).filter(EmailConfirm.user_id == user_id).first()
+    confirm = db.query(EmailConfirm).filter(EmailConfirm.user_id == user_id).order_by(EmailConfirm.id.desc()).first()
     if not confirm:
         return False
 
-    sender_email = "No Reply <no-reply@asgr-game.com>"
     receiver_email = f"{user.email}"
+    confirm_url = f"{api_url}/account/confirm_email/{confirm.unique}"
+
+    text = templates.render("email/confirm_email.txt", confirm_url=confirm_url)
+    html = templates.render("email/confirm_email.html", confirm_url=confirm_url)
+
+    queue_email(db, receiver_email, "Welcome to ASGR. Please confirm your e-mail address", text, html)
+    return True
 
+
+def build_message(outbox: EmailOutbox):
     message = MIMEMultipart("alternative")
-    message["Subject"] = "Welcome to ASGR. Please confirm your e-mail address"
-    message["From"] = sender_email
-    message["To"] = receiver_email
-
-    text = f"Hi,\n" \
-           f"This message was automatically generated during the account creation process in the ASGR application.\n" \
-           f"To confirm your email address, please click the link below.\n\n" \
-           f"{api_url}/account/confirm_email/{confirm.unique}\n\n" \
-           f"Link is active for 24 hours."
-
-    html = f"""\
-    <html>
-      <body>
-        <p>Hi,<br>
-           This message was automatically generated during the account creation process in the ASGR application.<br>
-           To confirm your email address, please click the link below.</p>
-        <p><a href="{api_url}/account/confirm_email/{confirm.unique}">Confirm e-mail</a></p>
-        <p> Link is active for 24 hours.</p>
-      </body>
-    </html>
-    """
-
-    part1 = MIMEText(text, "plain")
-    part2 = MIMEText(html, "html")
-    message.attach(part1)
-    message.attach(part2)
-
-    with smtplib.SMTP("sandbox.smtp.mailtrap.io", 2525) as server:
-        server.login(login, password)
-        server.sendmail(sender_email, receiver_email, message.as_string())
+    message["Subject"] = outbox.subject
+    message["From"] = outbox.sender
+    message["To"] = outbox.recipient
+    message.attach(MIMEText(outbox.body_text or "", "plain"))
+    if outbox.body_html:
+        message.attach(MIMEText(outbox.body_html, "html"))
+    return message
+
+
+class MailOutbox:
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, login=SMTP_LOGIN, password=SMTP_PASSWORD,
+                 starttls=SMTP_STARTTLS, poll_interval=OUTBOX_POLL_INTERVAL, batch_size=OUTBOX_BATCH_SIZE,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, retry_delay=OUTBOX_RETRY_DELAY,
+                 claim_timeout=OUTBOX_CLAIM_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.starttls = starttls
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+        self._server = None
+        self._last_used = 0.0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='mail-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._disconnect()
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                sent = self.process_batch()
+            except Exception:
+                sent = 0
+            if sent < self.batch_size:
+                if self._server is not None and time.monotonic() - self._last_used > SMTP_IDLE_TIMEOUT:
+                    self._disconnect()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def _connection(self):
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except smtplib.SMTPException:
+                pass
+            self._disconnect()
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            server.starttls()
+        if self.login:
+            server.login(self.login, self.password)
+        self._server = server
+        return server
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+    def process_batch(self):
+        # Claim, send, record: no transaction or pool connection is held while talking to the SMTP server
+        messages = self._claim()
+        if not messages:
+            return 0
+        errors = {outbox_id: self._deliver(sender, recipient, message)
+                  for outbox_id, sender, recipient, message in messages}
+        self._record(errors)
+        return len(messages)
+
+    def _claim(self):
+        db = SessionLocal()
+        try:
+            batch = db.query(EmailOutbox). \
+                filter(EmailOutbox.status == 'pending'). \
+                filter(EmailOutbox.next_attempt <= datetime.now()). \
+                order_by(EmailOutbox.next_attempt). \
+                limit(self.batch_size). \
+                with_for_update(skip_locked=True).all()
+            # Pushing next_attempt out is the claim: other workers skip the rows until the timeout passes
+            claimed_until = datetime.now() + timedelta(seconds=self.claim_timeout)
+            messages = []
+            for outbox in batch:
+                outbox.next_attempt = claimed_until
+                messages.append((outbox.id, outbox.sender, outbox.recipient, build_message(outbox).as_string()))
+            db.commit()
+            return messages
+        finally:
+            db.close()
+
+    def _deliver(self, sender, recipient, message):
+        try:
+            with external_call('smtp'):
+                server = self._connection()
+                server.sendmail(sender, recipient, message)
+        except (smtplib.SMTPException, OSError) as error:
+            self._disconnect()
+            return str(error)[:500]
+        self._last_used = time.monotonic()
+        return None
+
+    def _record(self, errors):
+        db = SessionLocal()
+        try:
+            for outbox in db.query(EmailOutbox).filter(EmailOutbox.id.in_(list(errors))):
+                error = errors[outbox.id]
+                if error is None:
+                    outbox.status = 'sent'
+                    outbox.sent_date = datetime.now()
+                    self.sent += 1
+                    continue
+                outbox.attempts = (outbox.attempts or 0) + 1
+                outbox.last_error = error
+                if outbox.attempts >= self.max_attempts:
+                    outbox.status = 'failed'
+                    self.failed += 1
+                else:
+                    outbox.next_attempt = datetime.now() + \
+                        timedelta(seconds=self.retry_delay * 2 ** (outbox.attempts - 1))
+            db.commit()
+        finally:
+            db.close()
+
+
+mail_outbox = MailOutbox()
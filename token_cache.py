@@ -0,0 +1,88 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, select
+
+from config import TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL
+from database import AsyncSessionLocal
+from models import Users
+
+
+def token_digest(token: str):
+    return hashlib.sha256(token.encode()).digest()
+
+
+class TokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str):
+        key = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token: str, claims: dict, token_expires: float):
+        expires = min(time.time() + self.ttl, token_expires)
+        with self._lock:
+            self._entries[token_digest(token)] = (expires, claims)
+            self._entries.move_to_end(token_digest(token))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TokenRevocations:
+    # Tokens carry users.token_generation at issue time; bumping the column invalidates every older token.
+    # The column is the shared truth and is read on token cache misses. This map only remembers the newest
+    # generation this process has seen, so tokens it already knows to be revoked fail without a query.
+    def __init__(self):
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, user_id: int):
+        return self._generations.get(user_id, 0)
+
+    def observe(self, user_id: int, generation: int):
+        with self._lock:
+            if generation > self._generations.get(user_id, 0):
+                self._generations[user_id] = generation
+
+    async def current(self, user_id: int):
+        # None when the account no longer exists
+        async with AsyncSessionLocal() as db:
+            generation = (await db.execute(select(Users.token_generation).where(Users.id == user_id))).scalar()
+        if generation is not None:
+            self.observe(user_id, generation)
+        return generation
+
+
+token_cache = TokenCache()
+token_revocations = TokenRevocations()
+
+
+@event.listens_for(Users.is_active, 'set')
+def _user_active_changed(target, value, old_value, initiator):
+    # Deactivating an account revokes its tokens in the same transaction
+    if target.id is not None and not value:
+        target.token_generation = (target.token_generation or 0) + 1